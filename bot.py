@@ -1,45 +1,184 @@
+import asyncio
+import atexit
+import bisect
+import contextvars
+import copy
+import csv
+import functools
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import json
 import logging
+import logging.handlers
+import multiprocessing
 import os
+import queue
+import random
+import re
+import secrets
+import select
 import subprocess
+import sys
+import threading
+import time
+import zipfile
+import zoneinfo
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
     ReplyKeyboardMarkup,
     KeyboardButton,
 )
+from telegram.error import BadRequest
+from telegram.request import BaseRequest, HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder,
+    BaseUpdateProcessor,
     CommandHandler,
     ContextTypes,
     ConversationHandler,
     MessageHandler,
     CallbackQueryHandler,
+    InlineQueryHandler,
+    TypeHandler,
     filters,
 )
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from psycopg2.pool import SimpleConnectionPool
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import PoolError, ThreadedConnectionPool
 from dotenv import load_dotenv
 
-load_dotenv()
-
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.WARNING
-)
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Render workers are spawned processes that import this module again, before parent_process()
+# is set but after they got their own name. Only the bot process loads .env (workers inherit its
+# environment), starts the log listener and opens the DB pool.
+RENDER_WORKER = multiprocessing.current_process().name != 'MainProcess'
+
+if not RENDER_WORKER:
+    load_dotenv()
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'WARNING').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+# "event=rate,..." — keep only this fraction of records tagged with extra={'event': ...}
+LOG_SAMPLING = {
+    event.strip(): float(rate)
+    for event, rate in (item.split('=') for item in os.getenv('LOG_SAMPLING', '').split(',') if item.strip())
+}
+
+correlation_id = contextvars.ContextVar('correlation_id', default=None)
+
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        record.correlation_id = correlation_id.get()
+        rate = LOG_SAMPLING.get(getattr(record, 'event', None))
+        return rate is None or random.random() < rate
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key in ('correlation_id', 'event'):
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_text:
+            entry['exc_info'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Render message and traceback here, keep extra fields for the formatter on the listener thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def setup_logging():
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    if LOG_FORMAT == 'json':
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - [%(correlation_id)s] %(message)s'))
+    queue_handler = StructuredQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+if not RENDER_WORKER:
+    setup_logging()
 
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.getenv('BOT_TOKEN')
+BOT_API_BASE_URL = os.getenv('BOT_API_BASE_URL')
 DB_HOST = os.getenv('DB_HOST')
 DB_PORT = os.getenv('DB_PORT', '5432')
 DB_NAME = os.getenv('DB_NAME')
 DB_USER = os.getenv('DB_USER')
 DB_PASSWORD = os.getenv('DB_PASSWORD')
 ADMIN_IDS = [int(id.strip()) for id in os.getenv('ADMIN_IDS').split(',')]
+ATTESTATION_CACHE_SIZE = int(os.getenv('ATTESTATION_CACHE_SIZE', '5000'))
+PURGE_BATCH_SIZE = int(os.getenv('PURGE_BATCH_SIZE', '500'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = os.getenv('METRICS_PORT')
+CALENDAR_HOST = os.getenv('CALENDAR_HOST', '127.0.0.1')
+CALENDAR_PORT = os.getenv('CALENDAR_PORT')
+CALENDAR_PUBLIC_URL = os.getenv('CALENDAR_PUBLIC_URL', f'http://{CALENDAR_HOST}:{CALENDAR_PORT}').rstrip('/')
+CALENDAR_FEED_DAYS = int(os.getenv('CALENDAR_FEED_DAYS', '120'))
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', '600'))
+DIGEST_TIME = datetime.strptime(os.getenv('DIGEST_TIME', '07:30'), '%H:%M').time()
+REMINDER_STORE_SIZE = int(os.getenv('REMINDER_STORE_SIZE', '50000'))
+REMINDER_CLEANUP_CONCURRENCY = int(os.getenv('REMINDER_CLEANUP_CONCURRENCY', '8'))
+REMINDER_CLEANUP_RATE = float(os.getenv('REMINDER_CLEANUP_RATE', '20'))
+FLOW_STATE_TTL = float(os.getenv('FLOW_STATE_TTL', '900'))
+CHECKIN_CODE_TTL = float(os.getenv('CHECKIN_CODE_TTL', '30'))
+CHECKIN_FLUSH_INTERVAL = float(os.getenv('CHECKIN_FLUSH_INTERVAL', '2'))
+CHECKIN_MAX_ATTEMPTS = int(os.getenv('CHECKIN_MAX_ATTEMPTS', '5'))
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '500'))
+SLOW_QUERY_EXPLAIN_RATE = float(os.getenv('SLOW_QUERY_EXPLAIN_RATE', '0'))
+DB_REPLICA_DSNS = [dsn.strip() for dsn in os.getenv('DB_REPLICA_DSNS', '').split(',') if dsn.strip()]
+DB_REPLICA_POOL_SIZE = int(os.getenv('DB_REPLICA_POOL_SIZE', '10'))
+DB_REPLICA_MAX_LAG = float(os.getenv('DB_REPLICA_MAX_LAG', '5'))
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv('DB_REPLICA_CHECK_INTERVAL', '5'))
+TELEGRAM_INTERACTIVE_POOL = int(os.getenv('TELEGRAM_INTERACTIVE_POOL', '32'))
+TELEGRAM_BULK_POOL = int(os.getenv('TELEGRAM_BULK_POOL', '8'))
+TELEGRAM_UPLOAD_POOL = int(os.getenv('TELEGRAM_UPLOAD_POOL', '2'))
+TELEGRAM_UPLOAD_TIMEOUT = float(os.getenv('TELEGRAM_UPLOAD_TIMEOUT', '300'))
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', '2'))
+RENDER_TIMEOUT = float(os.getenv('RENDER_TIMEOUT', '300'))
+INTAKE_CONCURRENCY = int(os.getenv('INTAKE_CONCURRENCY', '8'))
+INTAKE_QUEUE_LIMIT = int(os.getenv('INTAKE_QUEUE_LIMIT', '200'))
+INTAKE_RATE = float(os.getenv('INTAKE_RATE', '1'))
+INTAKE_BURST = float(os.getenv('INTAKE_BURST', '5'))
 
 ENTER_FIRST_NAME, ENTER_LAST_NAME, SELECT_GROUP = range(3)
 SELECT_STUDENT, ENTER_GRADE = range(3, 5)
@@ -47,8 +186,356 @@ EXPORT_SELECT_TABLE, EXPORT_SELECT_FORMAT = range(5, 7)
 BROADCAST_MESSAGE = range(7, 8)
 ASSIGN_REPRESENTATIVE, ASSIGN_DEPUTY = range(8, 10)
 CLASS_REPRESENTATIVE_MENU, ADMIN_MENU = range(10, 12)
+BULK_GRADES = 12
+IMPORT_ROSTER = 13
+PURGE_SELECT_SCOPE, PURGE_SELECT_TARGET, PURGE_CONFIRM = range(14, 17)
+EXPORT_REPORT_GROUP, EXPORT_REPORT_SEMESTER, EXPORT_REPORT_FORMAT = range(17, 20)
+IMPORT_TIMETABLE = 20
+
+BULK_GRADES_BUTTON = '📄 Таблица оценок'
+ATTENDANCE_REPORT_BUTTON = '📊 Отчёт посещаемости'
+SCHEDULE_TEXT_CACHE_SIZE = 20000
+CALENDAR_BUTTON = '🗓 Подписка на календарь'
+REMINDERS_BUTTON = '🔔 Напоминания'
+CHECKIN_BUTTON = '📍 Отметка на паре'
+CHECKIN_LINK_PREFIX = 'checkin_'
+CHECKIN_CODE = re.compile(r'\d{4}')
+CHECKIN_OPENS_BEFORE = timedelta(minutes=15)
+REPORT_FETCH_SIZE = 1000
+BULK_FILE_MAX_SIZE = 1024 * 1024
+
+# Prometheus-style metrics, served as text on METRICS_HOST:METRICS_PORT/metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+metrics_lock = threading.Lock()
+metrics_registry = []
+
+def format_label(label, value):
+    if label is None:
+        return ''
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return f'{label}="{value}"'
+
+class Histogram:
+    def __init__(self, name, documentation, label=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = buckets
+        self.series = {}
+        metrics_registry.append(self)
+
+    def observe(self, value, label_value=None):
+        with metrics_lock:
+            series = self.series.get(label_value)
+            if series is None:
+                # per-bucket counts (last one is +Inf), sum
+                series = self.series[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for label_value, (counts, total) in sorted(self.series.items(), key=lambda item: str(item[0])):
+            label = format_label(self.label, label_value)
+            prefix = f'{label},' if label else ''
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            suffix = f'{{{label}}}' if label else ''
+            lines.append(f'{self.name}_sum{suffix} {total}')
+            lines.append(f'{self.name}_count{suffix} {cumulative}')
+        return lines
+
+class Counter:
+    def __init__(self, name, documentation, label=None):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.series = {}
+        metrics_registry.append(self)
+
+    def inc(self, label_value=None, amount=1):
+        with metrics_lock:
+            self.series[label_value] = self.series.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for label_value, value in sorted(self.series.items(), key=lambda item: str(item[0])):
+            label = format_label(self.label, label_value)
+            lines.append(f'{self.name}{{{label}}} {value}' if label else f'{self.name} {value}')
+        return lines
+
+class Gauge:
+    def __init__(self, name, documentation, read):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+        metrics_registry.append(self)
+
+    def render(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge', f'{self.name} {self.read()}']
+
+handler_latency = Histogram('bot_handler_latency_seconds', 'Handler latency.', 'handler')
+db_query_latency = Histogram('bot_db_query_latency_seconds', 'Database statement latency.', 'statement')
+telegram_request_latency = Histogram('bot_telegram_request_latency_seconds', 'Bot API request latency.', 'method')
+telegram_request_errors = Counter('bot_telegram_request_errors_total', 'Failed Bot API requests.', 'method')
+scheduler_job_lag = Histogram('bot_scheduler_job_lag_seconds', 'Delay between scheduled and actual job start.', 'job')
+scheduler_job_duration = Histogram('bot_scheduler_job_duration_seconds', 'Scheduler job run time.', 'job')
+scheduler_jobs_missed = Counter('bot_scheduler_jobs_missed_total', 'Scheduler jobs that missed their run time.', 'job')
+# psycopg2 pools fail instead of queueing, so exhaustion is what "waiting" looks like here
+db_pool_exhausted = Counter('bot_db_pool_exhausted_total', 'Connection requests rejected because the pool was full.')
+
+def render_metrics():
+    with metrics_lock:
+        lines = []
+        for metric in metrics_registry:
+            lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server():
+    if not METRICS_PORT:
+        return
+    server = ThreadingHTTPServer((METRICS_HOST, int(METRICS_PORT)), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.warning(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+correlation_sequence = itertools.count(1)
+
+def track_latency(histogram=handler_latency):
+    def decorator(func):
+        label = func.__name__
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            # Updates get their id from assign_correlation_id; scheduler jobs get one here
+            token = correlation_id.set(f'{label}-{next(correlation_sequence)}') if correlation_id.get() is None else None
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, label)
+                if token:
+                    correlation_id.reset(token)
+        return wrapper
+    return decorator
+
+# Names come from the head of the statement only: execute_values() inlines every row into the query
+# text, and caching on the full text would keep those statements in memory
+STATEMENT_NAME_PREFIX = 1024
+
+def statement_name(query):
+    query = query[:STATEMENT_NAME_PREFIX]
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', errors='replace')
+    return statement_prefix_name(query)
+
+@functools.lru_cache(maxsize=1024)
+def statement_prefix_name(query):
+    words = query.split(None, 1)
+    verb = words[0].lower() if words else 'unknown'
+    match = re.search(r'\b(?:from|into|update|join)\s+([a-z_][a-z0-9_.]*)', query, re.IGNORECASE)
+    return f'{verb}_{match.group(1).lower()}' if match else verb
+
+SQL_STRING_LITERAL = re.compile(r"(?:\bE)?'(?:[^']|'')*'")
+SQL_NUMBER_LITERAL = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b')
+SQL_REPEATED_ROWS = re.compile(r'(\([^()]*\))(?:\s*,\s*\([^()]*\))+')
+SLOW_QUERY_LOG_CHARS = 2000
+
+def redact_sql(query):
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', errors='replace')
+    # Literals inlined by execute_values() or mogrify() become ?, and a VALUES list keeps one row
+    sql = SQL_NUMBER_LITERAL.sub('?', SQL_STRING_LITERAL.sub('?', query))
+    sql = SQL_REPEATED_ROWS.sub(r'\1, ...', ' '.join(sql.split()))
+    return sql if len(sql) <= SLOW_QUERY_LOG_CHARS else sql[:SLOW_QUERY_LOG_CHARS] + ' ...'
+
+def report_slow_query(query, vars, elapsed, failed):
+    sql = redact_sql(query)
+    # Only the statement template is logged; bound and inlined values may hold personal data
+    params = f' [параметров скрыто: {len(vars)}]' if vars else ''
+    logger.warning(f"Медленный запрос {statement_name(query)}: {elapsed * 1000:.0f} мс: {sql}{params}")
+    if failed or random.random() >= SLOW_QUERY_EXPLAIN_RATE:
+        return
+    if not re.match(r'(select|with)\b', sql, re.IGNORECASE) or re.search(r'\b(insert|update|delete)\b', sql, re.IGNORECASE):
+        # EXPLAIN ANALYZE executes the statement again, so writes are never explained
+        return
+    # The statement is re-run by the plan writer thread, not on the caller's connection and event loop
+    try:
+        slow_query_plans.put_nowait((statement_name(query), elapsed * 1000, sql, query, vars))
+    except queue.Full:
+        pass
+
+def write_slow_query_plans():
+    conn = None
+    while True:
+        name, duration_ms, sql, query, vars = slow_query_plans.get()
+        try:
+            if conn is None or conn.closed:
+                conn = psycopg2.connect(**DB_PARAMS)
+                conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            cursor = conn.cursor()
+            explain_sql = query.decode('utf-8') if isinstance(query, bytes) else query
+            # A read-only transaction that is always rolled back, whatever the statement calls
+            cursor.execute("BEGIN READ ONLY")
+            try:
+                cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + explain_sql, vars)
+                plan = cursor.fetchone()[0]
+            finally:
+                cursor.execute("ROLLBACK")
+            cursor.execute("""
+                INSERT INTO slow_query_plans (statement, duration_ms, query, plan)
+                VALUES (%s, %s, %s, %s)
+            """, (name, duration_ms, sql, json.dumps(plan)))
+            cursor.close()
+        except Exception as e:
+            logger.error(f"Ошибка при получении плана запроса {name}: {e}", exc_info=True)
+            if conn is not None:
+                conn.close()
+                conn = None
+
+slow_query_plans = queue.Queue(maxsize=100)
+
+def start_slow_query_log():
+    if SLOW_QUERY_MS and SLOW_QUERY_EXPLAIN_RATE > 0:
+        threading.Thread(target=write_slow_query_plans, name='slow-query-plans', daemon=True).start()
+
+instrumented_cursor_classes = {}
+
+def instrumented_cursor_class(base):
+    cls = instrumented_cursor_classes.get(base)
+    if cls is None:
+        class InstrumentedCursor(base):
+            def execute(self, query, vars=None):
+                start = time.perf_counter()
+                failed = True
+                try:
+                    result = super().execute(query, vars)
+                    failed = False
+                    return result
+                finally:
+                    elapsed = time.perf_counter() - start
+                    db_query_latency.observe(elapsed, statement_name(query))
+                    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+                        report_slow_query(query, vars, elapsed, failed)
+
+            def copy_expert(self, sql, file, size=8192):
+                start = time.perf_counter()
+                try:
+                    return super().copy_expert(sql, file, size)
+                finally:
+                    db_query_latency.observe(time.perf_counter() - start, statement_name(sql))
+
+        cls = instrumented_cursor_classes[base] = InstrumentedCursor
+    return cls
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = instrumented_cursor_class(base)
+        return super().cursor(*args, **kwargs)
+
+class MeteredRequest(HTTPXRequest):
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        try:
+            code, payload = await super().do_request(
+                url, method, request_data,
+                read_timeout=read_timeout,
+                write_timeout=write_timeout,
+                connect_timeout=connect_timeout,
+                pool_timeout=pool_timeout,
+            )
+        except Exception:
+            telegram_request_errors.inc(api_method)
+            raise
+        finally:
+            telegram_request_latency.observe(time.perf_counter() - start, api_method)
+        if code >= 400:
+            telegram_request_errors.inc(api_method)
+        return code, payload
+
+# Interactive replies, bulk fan-out and file uploads each get their own connection pool,
+# so a long upload or a reminder burst never queues a student's reply behind it
+http_route = contextvars.ContextVar('http_route', default='interactive')
+
+class RoutedRequest(BaseRequest):
+    def __init__(self):
+        self.pools = {
+            'interactive': MeteredRequest(connection_pool_size=TELEGRAM_INTERACTIVE_POOL),
+            'bulk': MeteredRequest(connection_pool_size=TELEGRAM_BULK_POOL, pool_timeout=30.0),
+            'upload': MeteredRequest(
+                connection_pool_size=TELEGRAM_UPLOAD_POOL,
+                read_timeout=60.0,
+                write_timeout=TELEGRAM_UPLOAD_TIMEOUT,
+                media_write_timeout=TELEGRAM_UPLOAD_TIMEOUT,
+                pool_timeout=TELEGRAM_UPLOAD_TIMEOUT,
+            ),
+        }
+
+    @property
+    def read_timeout(self):
+        return self.pools['interactive'].read_timeout
+
+    async def initialize(self):
+        for pool in self.pools.values():
+            await pool.initialize()
+
+    async def shutdown(self):
+        for pool in self.pools.values():
+            await pool.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        route = 'upload' if request_data is not None and request_data.contains_files else http_route.get()
+        return await self.pools[route].do_request(
+            url, method, request_data,
+            read_timeout=read_timeout,
+            write_timeout=write_timeout,
+            connect_timeout=connect_timeout,
+            pool_timeout=pool_timeout,
+        )
+
+def bulk_sends():
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            token = http_route.set('bulk')
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                http_route.reset(token)
+        return wrapper
+    return decorator
+
+def observe_job_submitted(event):
+    job = scheduler.get_job(event.job_id)
+    name = job.func.__name__ if job else event.job_id
+    lag = datetime.now(event.scheduled_run_times[0].tzinfo) - max(event.scheduled_run_times)
+    scheduler_job_lag.observe(max(lag.total_seconds(), 0), name)
 
-connection_pool = SimpleConnectionPool(1, 20,
+def observe_job_missed(event):
+    job = scheduler.get_job(event.job_id)
+    scheduler_jobs_missed.inc(job.func.__name__ if job else event.job_id)
+
+DB_PARAMS = dict(
     host=DB_HOST,
     port=DB_PORT,
     database=DB_NAME,
@@ -56,12 +543,245 @@ connection_pool = SimpleConnectionPool(1, 20,
     password=DB_PASSWORD
 )
 
+connection_pool = None if RENDER_WORKER else ThreadedConnectionPool(1, 20, connection_factory=InstrumentedConnection, **DB_PARAMS)
+
+# Handlers wrapped in read_only() take connections from a healthy replica, if any
+db_route = contextvars.ContextVar('db_route', default=None)
+
+class Replica:
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.pool = None
+        self.healthy = False
+
+replicas = [Replica(dsn) for dsn in DB_REPLICA_DSNS]
+replica_sequence = itertools.count()
+connection_owners = {}
+
+def get_replica_connection():
+    healthy = [replica for replica in replicas if replica.healthy]
+    if not healthy:
+        return None
+    offset = next(replica_sequence)
+    for i in range(len(healthy)):
+        replica = healthy[(offset + i) % len(healthy)]
+        try:
+            conn = replica.pool.getconn()
+        except PoolError:
+            # A busy pool is not an outage: try the next replica, then the primary
+            continue
+        except Exception as e:
+            logger.error(f"Реплика недоступна, переключение на основную базу: {e}")
+            replica.healthy = False
+            continue
+        connection_owners[id(conn)] = replica
+        return conn
+    return None
+
 def get_connection():
-    return connection_pool.getconn()
+    if db_route.get() == 'replica':
+        conn = get_replica_connection()
+        if conn is not None:
+            return conn
+    try:
+        return connection_pool.getconn()
+    except PoolError:
+        db_pool_exhausted.inc()
+        raise
 
 def release_connection(conn):
-    connection_pool.putconn(conn)
+    replica = connection_owners.pop(id(conn), None)
+    if replica is None:
+        connection_pool.putconn(conn)
+    elif conn.closed:
+        replica.healthy = False
+        replica.pool.putconn(conn, close=True)
+    else:
+        replica.pool.putconn(conn)
+
+def read_only():
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            token = db_route.set('replica')
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                db_route.reset(token)
+        return wrapper
+    return decorator
+
+def check_replicas():
+    check_connections = {}
+    while True:
+        for replica in replicas:
+            try:
+                if replica.pool is None:
+                    replica.pool = ThreadedConnectionPool(0, DB_REPLICA_POOL_SIZE, replica.dsn,
+                                                          connection_factory=InstrumentedConnection)
+                conn = check_connections.get(replica.dsn)
+                if conn is None or conn.closed:
+                    conn = check_connections[replica.dsn] = psycopg2.connect(replica.dsn)
+                    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                cursor = conn.cursor()
+                # An idle primary leaves the replay timestamp behind, so caught-up replicas report zero lag
+                cursor.execute("""
+                    SELECT CASE
+                        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+                    END
+                """)
+                lag = float(cursor.fetchone()[0])
+                cursor.close()
+                healthy = lag <= DB_REPLICA_MAX_LAG
+                if healthy != replica.healthy:
+                    logger.warning(f"Реплика {replica.dsn.split('@')[-1]}: {'доступна' if healthy else 'отстаёт'} (лаг {lag:.1f} с)")
+                replica.healthy = healthy
+            except Exception as e:
+                if replica.healthy:
+                    logger.error(f"Реплика {replica.dsn.split('@')[-1]} недоступна: {e}")
+                replica.healthy = False
+                conn = check_connections.pop(replica.dsn, None)
+                if conn is not None:
+                    conn.close()
+        time.sleep(DB_REPLICA_CHECK_INTERVAL)
+
+def start_replica_checks():
+    if replicas:
+        threading.Thread(target=check_replicas, name='replica-checks', daemon=True).start()
+
+# In-process copy of class_representatives / deputy_class_representatives
+# (telegram_id -> group_id, plus the reverse group_id -> telegram_id map under
+# ROLE_GROUP_KEYS). Kept coherent by the notify_role_change trigger
+# (see README) and a LISTEN connection, so every replica sees role changes.
+ROLE_CHANNEL = 'role_changes'
+ROLE_TABLES = ('class_representatives', 'deputy_class_representatives')
+
+ROLE_GROUP_KEYS = {table: f'{table}_by_group' for table in ROLE_TABLES}
+
+role_cache = {key: {} for key in (*ROLE_TABLES, *ROLE_GROUP_KEYS.values())}
+role_cache_lock = threading.Lock()
+
+def load_role_cache(conn=None):
+    # The listener thread reloads over its dedicated connection instead of the pool
+    pooled = conn is None
+    if pooled:
+        conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        loaded = {}
+        for table in ROLE_TABLES:
+            cursor.execute(f"SELECT telegram_id, group_id FROM {table}")
+            rows = cursor.fetchall()
+            loaded[table] = dict(rows)
+            loaded[ROLE_GROUP_KEYS[table]] = {group_id: telegram_id for telegram_id, group_id in rows}
+        conn.commit()
+    finally:
+        cursor.close()
+        if pooled:
+            release_connection(conn)
+    with role_cache_lock:
+        role_cache.update(loaded)
+    logger.warning(f"Кэш ролей загружен: {len(loaded['class_representatives'])} старост, "
+                   f"{len(loaded['deputy_class_representatives'])} заместителей")
+
+def apply_role_change(table, old=None, new=None):
+    # Copy-on-write: readers keep iterating over the previous dict safely.
+    with role_cache_lock:
+        entries = dict(role_cache[table])
+        by_group = dict(role_cache[ROLE_GROUP_KEYS[table]])
+        for row in (old, new):
+            if row:
+                group_id = entries.pop(row['telegram_id'], None)
+                if by_group.get(group_id) == row['telegram_id']:
+                    del by_group[group_id]
+        if new:
+            entries[new['telegram_id']] = new['group_id']
+            by_group[new['group_id']] = new['telegram_id']
+        role_cache[table] = entries
+        role_cache[ROLE_GROUP_KEYS[table]] = by_group
+
+def handle_role_notification(payload, conn=None):
+    global subject_catalog
+    data = json.loads(payload)
+    # Calendar and timetable tables share the channel: the calendar index is rebuilt,
+    # cached timetables and .ics feeds of the affected groups are dropped
+    if data.get('table') in CALENDAR_TABLES:
+        load_academic_calendar()
+        invalidate_group_timetables()
+        return
+    if data.get('table') in FEED_TABLES:
+        if data.get('table') == 'subjects':
+            subject_catalog = None
+        if data['op'] == 'TRUNCATE' or data.get('table') == 'subjects':
+            invalidate_group_timetables()
+        else:
+            invalidate_group_timetables({row['group_id'] for row in (data.get('old'), data.get('new')) if row})
+        return
+    if data.get('table') not in ROLE_TABLES:
+        return
+    if data['op'] == 'TRUNCATE':
+        load_role_cache(conn)
+    else:
+        apply_role_change(data['table'], data.get('old'), data.get('new'))
+
+def listen_role_changes():
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(**DB_PARAMS)
+            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            cursor = conn.cursor()
+            cursor.execute(f"LISTEN {ROLE_CHANNEL}")
+            cursor.close()
+            # Reload after subscribing so changes made while disconnected are not lost.
+            load_role_cache(conn)
+            load_academic_calendar()
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    try:
+                        handle_role_notification(notify.payload, conn)
+                    except Exception as e:
+                        logger.error(f"Ошибка при обработке уведомления о ролях: {e}", exc_info=True)
+        except Exception as e:
+            logger.error(f"Ошибка в listen_role_changes: {e}", exc_info=True)
+            time.sleep(5)
+        finally:
+            if conn:
+                conn.close()
+
+def start_role_cache():
+    load_role_cache()
+    load_academic_calendar()
+    threading.Thread(target=listen_role_changes, name='role-listener', daemon=True).start()
+
+Gauge('bot_db_pool_in_use', 'Connections currently checked out of the pool.', lambda: len(connection_pool._used))
+Gauge('bot_db_pool_idle', 'Idle connections kept in the pool.', lambda: len(connection_pool._pool))
+Gauge('bot_db_pool_max', 'Pool size limit.', lambda: connection_pool.maxconn)
+Gauge('bot_db_replicas_healthy', 'Replicas currently used for read-only handlers.', lambda: sum(replica.healthy for replica in replicas))
+
+def get_representative_group(telegram_id):
+    return role_cache['class_representatives'].get(telegram_id)
 
+def get_deputy_group(telegram_id):
+    return role_cache['deputy_class_representatives'].get(telegram_id)
+
+def get_role_group(telegram_id):
+    group_id = get_representative_group(telegram_id)
+    if group_id is None:
+        group_id = get_deputy_group(telegram_id)
+    return group_id
+
+def get_group_representatives(group_id):
+    starosta = role_cache[ROLE_GROUP_KEYS['class_representatives']].get(group_id)
+    deputy = role_cache[ROLE_GROUP_KEYS['deputy_class_representatives']].get(group_id)
+    return starosta, deputy
+
+from apscheduler.events import EVENT_JOB_MISSED, EVENT_JOB_SUBMITTED
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.date import DateTrigger
 from apscheduler.triggers.cron import CronTrigger
@@ -69,6 +789,10 @@ from apscheduler.triggers.interval import IntervalTrigger
 
 scheduler = None
 
+# Scheduler jobs read the time through this hook so scheduler_sim.py can drive them on a virtual clock
+def current_time():
+    return datetime.now()
+
 def main_menu():
     keyboard = [
         ['📅 Расписание', '📝 Аттестация']
@@ -99,7 +823,7 @@ def combined_main_menu():
 def class_representative_menu():
     keyboard = [
         ['📨 Объяснительные', '📝 Выставить аттестацию'],
-        ['📢 Рассылка сообщения'],
+        ['📢 Рассылка сообщения', CHECKIN_BUTTON],
         ['👥 Назначить заместителя', '🔙 Главное меню']
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
@@ -108,22 +832,15 @@ def admin_menu():
     keyboard = [
         ['👤 Назначить старосту', '🗑 Удалить пользователей'],
         ['💾 Резервное копирование', '📤 Экспорт данных'],
+        ['📥 Импорт студентов', '🗓 Импорт расписания'],
         ['🔙 Главное меню']
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
 def get_user_menu(telegram_id):
     is_admin = telegram_id in ADMIN_IDS
-    conn = get_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1 FROM class_representatives WHERE telegram_id = %s", (telegram_id,))
-        is_representative = cursor.fetchone() is not None
-        cursor.execute("SELECT 1 FROM deputy_class_representatives WHERE telegram_id = %s", (telegram_id,))
-        is_deputy = cursor.fetchone() is not None
-    finally:
-        cursor.close()
-        release_connection(conn)
+    is_representative = get_representative_group(telegram_id) is not None
+    is_deputy = get_deputy_group(telegram_id) is not None
 
     if is_admin and (is_representative or is_deputy):
         return combined_main_menu()
@@ -134,8 +851,14 @@ def get_user_menu(telegram_id):
     else:
         return main_menu()
 
+@track_latency()
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     telegram_id = update.message.from_user.id
+    if context.args and context.args[0].startswith(CHECKIN_LINK_PREFIX):
+        await submit_checkin(update, context.args[0][len(CHECKIN_LINK_PREFIX):])
+        return ConversationHandler.END
+    if context.args:
+        return await link_student_by_code(update, context, context.args[0])
     conn = get_connection()
     try:
         cursor = conn.cursor()
@@ -165,12 +888,49 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ENTER_FIRST_NAME
 
+async def link_student_by_code(update: Update, context: ContextTypes.DEFAULT_TYPE, invite_code):
+    telegram_id = update.message.from_user.id
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE students SET telegram_id = %s, invite_code = NULL
+            WHERE invite_code = %s AND telegram_id IS NULL
+            RETURNING first_name, last_name
+        """, (telegram_id, invite_code))
+        result = cursor.fetchone()
+        conn.commit()
+    except psycopg2.errors.UniqueViolation:
+        conn.rollback()
+        await update.message.reply_text('Вы уже зарегистрированы!', reply_markup=get_user_menu(telegram_id))
+        return ConversationHandler.END
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Ошибка в link_student_by_code: {e}", exc_info=True)
+        await update.message.reply_text('Произошла ошибка при обработке вашего запроса.')
+        return ConversationHandler.END
+    finally:
+        cursor.close()
+        release_connection(conn)
+
+    if result:
+        await update.message.reply_text(
+            f'{result[0]} {result[1]}, вы успешно зарегистрированы!',
+            reply_markup=get_user_menu(telegram_id)
+        )
+    else:
+        await update.message.reply_text(
+            'Код приглашения недействителен или уже использован. '
+            'Отправьте /start, чтобы зарегистрироваться вручную.'
+        )
+    return ConversationHandler.END
+
 async def enter_first_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     if text == 'Назад':
         await update.message.reply_text('Регистрация отменена.', reply_markup=main_menu())
         return ConversationHandler.END
-    context.user_data['first_name'] = text
+    flow_states.start(update.message.from_user.id, RegistrationFlow(first_name=text))
     keyboard = [[KeyboardButton('Назад')]]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     await update.message.reply_text('Введите вашу фамилию:', reply_markup=reply_markup)
@@ -183,7 +943,10 @@ async def enter_last_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
         await update.message.reply_text('Введите ваше имя:', reply_markup=reply_markup)
         return ENTER_FIRST_NAME
-    context.user_data['last_name'] = text
+    flow = flow_states.get(update.message.from_user.id, RegistrationFlow)
+    if flow is None:
+        return await flow_expired(update)
+    flow.last_name = text
 
     conn = get_connection()
     try:
@@ -206,6 +969,7 @@ async def enter_last_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text('Пожалуйста, выберите вашу группу:', reply_markup=reply_markup)
     return SELECT_GROUP
 
+@track_latency()
 async def select_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
     group_name = update.message.text.strip()
     if group_name == 'Назад':
@@ -213,6 +977,9 @@ async def select_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
         await update.message.reply_text('Введите вашу фамилию:', reply_markup=reply_markup)
         return ENTER_LAST_NAME
+    flow = flow_states.get(update.message.from_user.id, RegistrationFlow)
+    if flow is None:
+        return await flow_expired(update)
     conn = get_connection()
     try:
         cursor = conn.cursor()
@@ -223,14 +990,10 @@ async def select_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try:
                 cursor.execute(
                     "INSERT INTO students (first_name, last_name, group_id, telegram_id) VALUES (%s, %s, %s, %s)",
-                    (
-                        context.user_data['first_name'],
-                        context.user_data['last_name'],
-                        group_id,
-                        update.message.from_user.id
-                    )
+                    (flow.first_name, flow.last_name, group_id, update.message.from_user.id)
                 )
                 conn.commit()
+                flow_states.end(update.message.from_user.id, RegistrationFlow)
                 menu = get_user_menu(update.message.from_user.id)
                 await update.message.reply_text(
                     'Вы успешно зарегистрированы!',
@@ -262,39 +1025,37 @@ async def select_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
         release_connection(conn)
     return ConversationHandler.END
 
+async def assign_correlation_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    correlation_id.set(f'u{update.update_id}')
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         'Регистрация отменена.', reply_markup=main_menu()
     )
     return ConversationHandler.END
 
+@track_latency()
 async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if context.user_data.get('awaiting_broadcast'):
+    user_id = update.message.from_user.id
+    if flow_states.get(user_id, BroadcastFlow):
         await handle_broadcast_message(update, context)
         return
-    if context.user_data.get('awaiting_representative_id'):
-        await handle_assign_representative(update, context)
-        return
-    if context.user_data.get('awaiting_deputy_id'):
-        await handle_assign_deputy(update, context)
+    role_flow = flow_states.get(user_id, RoleAssignmentFlow)
+    if role_flow:
+        if role_flow.table == 'class_representatives':
+            await handle_assign_representative(update, context)
+        else:
+            await handle_assign_deputy(update, context)
         return
-    if context.user_data.get('awaiting_explanation'):
+    if flow_states.get(user_id, ExplanationFlow):
         await handle_explanation(update, context)
         return
 
     text = update.message.text
     telegram_id = update.message.from_user.id
     is_admin = telegram_id in ADMIN_IDS
-    conn = get_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1 FROM class_representatives WHERE telegram_id = %s", (telegram_id,))
-        is_representative = cursor.fetchone() is not None
-        cursor.execute("SELECT 1 FROM deputy_class_representatives WHERE telegram_id = %s", (telegram_id,))
-        is_deputy = cursor.fetchone() is not None
-    finally:
-        cursor.close()
-        release_connection(conn)
+    is_representative = get_representative_group(telegram_id) is not None
+    is_deputy = get_deputy_group(telegram_id) is not None
 
     if text == '📅 Расписание':
         await schedule_menu(update, context)
@@ -318,6 +1079,14 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     elif text in ['Сегодня', 'Завтра', 'На неделю']:
         await show_schedule(update, context)
+    elif text == CALENDAR_BUTTON and CALENDAR_PORT:
+        await show_calendar_link(update, context)
+    elif text == REMINDERS_BUTTON:
+        await show_reminder_settings(update, context)
+    elif CHECKIN_CODE.fullmatch(text.strip()) and telegram_id in checkin_participants:
+        await submit_checkin(update, text.strip())
+    elif (is_representative or is_deputy) and text == CHECKIN_BUTTON:
+        await start_checkin(update, context)
     elif (is_representative or is_deputy) and text == '📨 Объяснительные':
         await view_explanations(update, context)
     elif (is_representative or is_deputy) and text == '📝 Выставить аттестацию':
@@ -334,8 +1103,15 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ASSIGN_REPRESENTATIVE
     elif is_admin and text == '🗑 Удалить пользователей':
         await clean_users(update, context)
+        return PURGE_SELECT_SCOPE
     elif is_admin and text == '💾 Резервное копирование':
         await backup_database(update, context)
+    elif is_admin and text == '📥 Импорт студентов':
+        await import_roster_start(update, context)
+        return IMPORT_ROSTER
+    elif is_admin and text == '🗓 Импорт расписания':
+        await import_timetable_start(update, context)
+        return IMPORT_TIMETABLE
     elif is_admin and text == '📤 Экспорт данных':
         await export_data_start(update, context)
         return EXPORT_SELECT_TABLE
@@ -349,8 +1125,8 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def schedule_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         ['Сегодня', 'Завтра'],
-        ['На неделю'],
-        ['Главное меню']
+        ['На неделю', CALENDAR_BUTTON] if CALENDAR_PORT else ['На неделю'],
+        [REMINDERS_BUTTON, 'Главное меню']
     ]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
@@ -359,106 +1135,619 @@ async def schedule_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup
     )
 
-def get_week_type(target_date):
-    week_number = target_date.isocalendar()[1]
-    return 'only_even' if week_number % 2 == 0 else 'only_odd'
+WEEKDAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+CALENDAR_TABLES = ('academic_semesters', 'calendar_overrides')
+CALENDAR_FALLBACK_DAYS = 5 * 366
+
+# weekday is the day whose timetable applies, which differs from the date on transferred days
+CalendarDay = namedtuple('CalendarDay', 'is_study_day week_type weekday note')
+NO_CLASSES = CalendarDay(False, None, None, None)
+
+# date -> CalendarDay, rebuilt as a whole and swapped in so lookups never see a partial index
+academic_calendar = {}
+
+def iso_week_type(day):
+    return 'only_even' if day.isocalendar()[1] % 2 == 0 else 'only_odd'
+
+def build_academic_calendar(semesters, overrides, today):
+    index = {}
+    if semesters:
+        for start, end, first_week_type in semesters:
+            other_week_type = 'only_even' if first_week_type == 'only_odd' else 'only_odd'
+            first_monday = start - timedelta(days=start.weekday())
+            day = start
+            while day <= end:
+                week_type = first_week_type if (day - first_monday).days // 7 % 2 == 0 else other_week_type
+                index[day] = CalendarDay(True, week_type, WEEKDAYS[day.weekday()], None)
+                day += timedelta(days=1)
+    else:
+        # Without semesters every day is a study day and weeks alternate by ISO number, as before
+        day = today - timedelta(days=CALENDAR_FALLBACK_DAYS)
+        while day <= today + timedelta(days=CALENDAR_FALLBACK_DAYS):
+            index[day] = CalendarDay(True, iso_week_type(day), WEEKDAYS[day.weekday()], None)
+            day += timedelta(days=1)
+    for day, is_study_day, weekday, week_type, note in overrides:
+        if not is_study_day:
+            index[day] = CalendarDay(False, None, None, note)
+            continue
+        base = index.get(day)
+        index[day] = CalendarDay(
+            True,
+            week_type or (base.week_type if base and base.week_type else iso_week_type(day)),
+            weekday or WEEKDAYS[day.weekday()],
+            note,
+        )
+    return index
 
+def load_academic_calendar():
+    global academic_calendar
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT start_date, end_date, first_week_type FROM academic_semesters ORDER BY start_date")
+        semesters = cursor.fetchall()
+        cursor.execute("SELECT date, is_study_day, weekday, week_type, note FROM calendar_overrides")
+        overrides = cursor.fetchall()
+        conn.commit()
+    finally:
+        cursor.close()
+        release_connection(conn)
+    academic_calendar = build_academic_calendar(semesters, overrides, current_time().date())
+    logger.warning(f"Учебный календарь загружен: семестров {len(semesters)}, исключений {len(overrides)}")
+
+def calendar_day(day):
+    return academic_calendar.get(day, NO_CLASSES)
+
+def schedule_period_dates(period, today):
+    if period == 'Сегодня':
+        return [today]
+    if period == 'Завтра':
+        return [today + timedelta(days=1)]
+    if period == 'На неделю':
+        monday = today - timedelta(days=today.weekday())
+        return [monday + timedelta(days=i) for i in range(7)]
+    return None
+
+@track_latency()
+@read_only()
 async def show_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
     period = update.message.text
     telegram_id = update.message.from_user.id
-    conn = get_connection()
     try:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-
-        cursor.execute("""
-            SELECT g.id FROM students s
-            JOIN groups g ON s.group_id = g.id
-            WHERE s.telegram_id = %s
-        """, (telegram_id,))
-        result = cursor.fetchone()
-
-        if result:
-            group_id = result['id']
-            today = datetime.now()
-            today_date = today.date()
-
-            if period == 'Сегодня':
-                target_dates = [today_date]
-            elif period == 'Завтра':
-                target_dates = [today_date + timedelta(days=1)]
-            elif period == 'На неделю':
-                today_weekday = today.weekday()
-                monday_date = today_date - timedelta(days=today_weekday)
-                target_dates = [monday_date + timedelta(days=i) for i in range(7)]
-            else:
-                await update.message.reply_text('Неверный период.')
-                return
-
-            response = ''
-            for target_date in target_dates:
-                day_of_week = target_date.strftime('%A')
-                week_type = get_week_type(target_date)
-                cursor.execute("""
-                    SELECT s.start_time, s.end_time, sub.name, s.class_type
-                    FROM schedules s
-                    JOIN subjects sub ON s.subject_id = sub.id
-                    WHERE s.group_id = %s AND s.day_of_week = %s AND s.week_type IN ('all', %s)
-                    ORDER BY s.start_time
-                """, (group_id, day_of_week, week_type))
-                schedule_rows = cursor.fetchall()
-                date_str = target_date.strftime('%d.%m.%Y')
-                if schedule_rows:
-                    response += f'\n📅 Расписание на {date_str}:\n'
-                    for row in schedule_rows:
-                        start_time = row['start_time'].strftime('%H:%M')
-                        end_time = row['end_time'].strftime('%H:%M')
-                        subject_name = row['name']
-                        class_type = row['class_type']
-                        class_type_ru = {
-                            'lecture': 'Лекция',
-                            'practice': 'Практика',
-                            'lab': 'Лабораторная работа'
-                        }.get(class_type, class_type)
-                        response += f"{start_time} - {end_time}: {subject_name} ({class_type_ru})\n"
-                else:
-                    response += f'\nНа {date_str} занятий нет.\n'
-            await update.message.reply_text(response, reply_markup=get_user_menu(telegram_id))
-        else:
+        group_id = get_student_group(telegram_id)
+        if group_id is None:
             await update.message.reply_text(
                 'Вы не зарегистрированы. Пожалуйста, используйте команду /start для регистрации.'
             )
+            return
+        target_dates = schedule_period_dates(period, datetime.now().date())
+        if target_dates is None:
+            await update.message.reply_text('Неверный период.')
+            return
+        response = ''.join(day_schedule_text(group_id, target_date) for target_date in target_dates)
+        await update.message.reply_text(response, reply_markup=get_user_menu(telegram_id))
     except Exception as e:
         logger.error(f"Ошибка в show_schedule: {e}", exc_info=True)
         await update.message.reply_text('Произошла ошибка при получении расписания.')
+
+CLASS_TYPE_NAMES = {'lecture': 'Лекция', 'practice': 'Практика', 'lab': 'Лабораторная работа'}
+FEED_TABLES = ('schedules', 'subjects')
+MOSCOW = zoneinfo.ZoneInfo('Europe/Moscow')
+
+# by_weekday maps 'Monday' -> [(schedule_id, day_of_week, week_type, start_time, end_time, subject, class_type)]
+GroupTimetable = namedtuple('GroupTimetable', 'name by_weekday')
+
+# group_id -> GroupTimetable, group_id -> (generated_on, etag, body) for .ics feeds and
+# group_id -> ((subject_id, name), ...) from group_curriculum. All are dropped when the group's
+# timetable changes; the generation counter keeps a load that raced with an invalidation from
+# caching rows that are already stale.
+group_timetables = {}
+calendar_feeds = {}
+group_curricula = {}
+timetable_generation = 0
+timetable_lock = threading.Lock()
+
+def invalidate_group_timetables(group_ids=None):
+    global timetable_generation
+    with timetable_lock:
+        timetable_generation += 1
+        if group_ids is None:
+            group_timetables.clear()
+            calendar_feeds.clear()
+            group_curricula.clear()
+        else:
+            for group_id in group_ids:
+                group_timetables.pop(group_id, None)
+                calendar_feeds.pop(group_id, None)
+                group_curricula.pop(group_id, None)
+
+def get_group_timetable(group_id):
+    with timetable_lock:
+        timetable = group_timetables.get(group_id)
+        generation = timetable_generation
+    if timetable is not None:
+        return timetable
+    # The cache is filled from the primary: a lagging replica could put back the timetable
+    # an invalidation has just dropped, and it would stay until the next change
+    token = db_route.set(None)
+    try:
+        conn = get_connection()
+    finally:
+        db_route.reset(token)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM groups WHERE id = %s", (group_id,))
+        group = cursor.fetchone()
+        cursor.execute("""
+            SELECT s.id, s.day_of_week, s.week_type, s.start_time, s.end_time, sub.name, s.class_type
+            FROM schedules s
+            JOIN subjects sub ON s.subject_id = sub.id
+            WHERE s.group_id = %s
+            ORDER BY s.start_time
+        """, (group_id,))
+        classes = cursor.fetchall()
+        conn.commit()
     finally:
         cursor.close()
         release_connection(conn)
-
-async def view_attestation(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    telegram_id = update.message.from_user.id
+    if group is None:
+        return None
+    by_weekday = {}
+    for row in classes:
+        by_weekday.setdefault(row[1], []).append(row)
+    timetable = GroupTimetable(group[0], by_weekday)
+    with timetable_lock:
+        if generation == timetable_generation:
+            group_timetables[group_id] = timetable
+    return timetable
+
+# Subjects the group actually takes, kept in sync with schedules by a trigger on the view
+def get_group_curriculum(group_id):
+    with timetable_lock:
+        curriculum = group_curricula.get(group_id)
+        generation = timetable_generation
+    if curriculum is not None:
+        return curriculum
     conn = get_connection()
     try:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT sub.id, sub.name
+            FROM group_curriculum gc
+            JOIN subjects sub ON sub.id = gc.subject_id
+            WHERE gc.group_id = %s
+            ORDER BY sub.name
+        """, (group_id,))
+        curriculum = tuple(cursor.fetchall())
+        conn.commit()
+    finally:
+        cursor.close()
+        release_connection(conn)
+    with timetable_lock:
+        if generation == timetable_generation:
+            group_curricula[group_id] = curriculum
+    return curriculum
+
+def classes_on(timetable, calendar):
+    if timetable is None or not calendar.is_study_day:
+        return []
+    return [row for row in timetable.by_weekday.get(calendar.weekday, ()) if row[2] in ('all', calendar.week_type)]
+
+def ics_escape(value):
+    return value.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+def ics_line(line):
+    # RFC 5545 folds lines longer than 75 octets, continuation lines start with a space
+    encoded = line.encode('utf-8')
+    parts = []
+    while len(encoded) > 75:
+        cut = 75 if not parts else 74
+        while encoded[cut] & 0xC0 == 0x80:
+            cut -= 1
+        parts.append(encoded[:cut])
+        encoded = encoded[cut:]
+    parts.append(encoded)
+    return b'\r\n '.join(parts) + b'\r\n'
+
+def ics_time(day, moment):
+    return datetime.combine(day, moment, MOSCOW).astimezone(zoneinfo.ZoneInfo('UTC')).strftime('%Y%m%dT%H%M%SZ')
+
+def build_calendar_feed(group_id, today):
+    timetable = get_group_timetable(group_id)
+    if timetable is None:
+        return None
+    first_day = today - timedelta(days=7)
+    stamp = f'{first_day:%Y%m%d}T000000Z'
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//University bot//Schedule//RU',
+        'CALSCALE:GREGORIAN',
+        f'X-WR-CALNAME:{ics_escape("Расписание " + timetable.name)}',
+        'X-PUBLISHED-TTL:PT1H',
+    ]
+    for offset in range(CALENDAR_FEED_DAYS + 7):
+        day = first_day + timedelta(days=offset)
+        for schedule_id, _, _, start_time, end_time, subject_name, class_type in classes_on(timetable, calendar_day(day)):
+            lines += [
+                'BEGIN:VEVENT',
+                f'UID:{schedule_id}-{day:%Y%m%d}@university-bot',
+                f'DTSTAMP:{stamp}',
+                f'DTSTART:{ics_time(day, start_time)}',
+                f'DTEND:{ics_time(day, end_time)}',
+                f'SUMMARY:{ics_escape(f"{subject_name} ({CLASS_TYPE_NAMES.get(class_type, class_type)})")}',
+                'END:VEVENT',
+            ]
+    lines.append('END:VCALENDAR')
+    return b''.join(ics_line(line) for line in lines)
+
+def get_calendar_feed(group_id):
+    today = current_time().date()
+    with timetable_lock:
+        cached = calendar_feeds.get(group_id)
+        generation = timetable_generation
+    if cached and cached[0] == today:
+        return cached
+    body = build_calendar_feed(group_id, today)
+    if body is None:
+        return None
+    feed = (today, f'"{hashlib.sha1(body).hexdigest()}"', body)
+    with timetable_lock:
+        if generation == timetable_generation:
+            calendar_feeds[group_id] = feed
+    return feed
+
+class CalendarRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        match = re.fullmatch(r'/calendar/(\d+)\.ics', self.path.split('?', 1)[0])
+        if not match:
+            self.send_error(404)
+            return
+        try:
+            feed = get_calendar_feed(int(match.group(1)))
+        except Exception as e:
+            logger.error(f"Ошибка при формировании календаря: {e}", exc_info=True)
+            self.send_error(503)
+            return
+        if feed is None:
+            self.send_error(404)
+            return
+        _, etag, body = feed
+        if etag in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/calendar; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'max-age=900')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
 
-        cursor.execute("SELECT id FROM students WHERE telegram_id = %s", (telegram_id,))
-        student = cursor.fetchone()
+def start_calendar_server():
+    if not CALENDAR_PORT:
+        return
+    server = ThreadingHTTPServer((CALENDAR_HOST, int(CALENDAR_PORT)), CalendarRequestHandler)
+    threading.Thread(target=server.serve_forever, name='calendar-server', daemon=True).start()
+    logger.warning(f"Календари групп доступны на {CALENDAR_PUBLIC_URL}/calendar/<id группы>.ics")
+
+@track_latency()
+async def show_calendar_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    group_id = get_student_group(update.message.from_user.id)
+    if group_id is None:
+        await update.message.reply_text('Вы не зарегистрированы. Пожалуйста, используйте команду /start для регистрации.')
+        return
+    await update.message.reply_text(
+        'Добавьте ссылку в приложение календаря как подписку, и расписание группы будет обновляться само:\n'
+        f'{CALENDAR_PUBLIC_URL}/calendar/{group_id}.ics'
+    )
+
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def pop(self, key):
+        return self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+# State of multi-step flows. Each flow keeps ids, indexes and references to shared caches
+# (listed in shared, not counted towards the user's footprint), never per-user copies of lists.
+class FlowState:
+    __slots__ = ()
+    shared = ()
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+    def footprint(self):
+        return sys.getsizeof(self) + sum(
+            sys.getsizeof(getattr(self, name)) for name in self.__slots__ if name not in self.shared
+        )
+
+class RegistrationFlow(FlowState):
+    __slots__ = ('first_name', 'last_name')
+
+class AttestationFlow(FlowState):
+    # subjects is the group's curriculum (or the shared subject catalog), subject_index the subject being graded
+    __slots__ = ('group_id', 'student_id', 'subjects', 'subject_index')
+    shared = ('subjects',)
+
+class ExportFlow(FlowState):
+    __slots__ = ('table',)
+
+class ReportFlow(FlowState):
+    __slots__ = ('group_id', 'group_name', 'semesters', 'semester')
+
+class PurgeFlow(FlowState):
+    __slots__ = ('scope', 'value', 'total')
+
+class BroadcastFlow(FlowState):
+    __slots__ = ()
+
+class RoleAssignmentFlow(FlowState):
+    __slots__ = ('table',)
+
+class ExplanationFlow(FlowState):
+    __slots__ = ('student_id', 'subject_id')
+
+# (telegram_id, flow class) -> (touched_at, state), least recently touched first. A state idle
+# for FLOW_STATE_TTL is dropped on the next access, so abandoned flows and prompts don't linger.
+class FlowStates:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def expire(self):
+        deadline = time.monotonic() - self.ttl
+        while self.entries:
+            key, (touched_at, _) = next(iter(self.entries.items()))
+            if touched_at > deadline:
+                break
+            del self.entries[key]
+            flow_states_expired.inc(key[1].__name__)
+
+    def start(self, telegram_id, state):
+        self.expire()
+        key = (telegram_id, type(state))
+        self.entries.pop(key, None)
+        self.entries[key] = (time.monotonic(), state)
+        return state
+
+    def get(self, telegram_id, kind):
+        self.expire()
+        entry = self.entries.pop((telegram_id, kind), None)
+        if entry is None:
+            return None
+        self.entries[(telegram_id, kind)] = (time.monotonic(), entry[1])
+        return entry[1]
+
+    def end(self, telegram_id, kind):
+        self.entries.pop((telegram_id, kind), None)
+
+    def forget(self, telegram_ids):
+        for key in [key for key in self.entries if key[0] in telegram_ids]:
+            del self.entries[key]
+
+    def users(self):
+        return len({telegram_id for telegram_id, _ in list(self.entries)})
+
+    def footprint(self):
+        return sum(state.footprint() for _, state in list(self.entries.values()))
+
+flow_states = FlowStates(FLOW_STATE_TTL)
+flow_states_expired = Counter('bot_flow_states_expired_total', 'Flow states dropped after FLOW_STATE_TTL of inactivity.', 'flow')
+Gauge('bot_flow_states', 'Flow states currently kept.', lambda: len(flow_states.entries))
+Gauge('bot_flow_state_bytes', 'Approximate memory held by flow states.', flow_states.footprint)
+Gauge('bot_flow_state_bytes_per_user', 'Approximate flow state memory per user with an active flow.',
+      lambda: flow_states.footprint() / max(1, flow_states.users()))
+
+async def flow_expired(update: Update):
+    await update.message.reply_text(
+        'Время ожидания истекло, начните заново из меню.',
+        reply_markup=get_user_menu(update.message.from_user.id)
+    )
+    return ConversationHandler.END
+
+# [(subject_id, name), ...] ordered by name, shared by all grading flows and dropped on subject changes
+subject_catalog = None
 
-        if student:
+def get_subject_catalog():
+    global subject_catalog
+    catalog = subject_catalog
+    if catalog is None:
+        conn = get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, name FROM subjects ORDER BY name ASC")
+            catalog = tuple(cursor.fetchall())
+            conn.commit()
+        finally:
+            cursor.close()
+            release_connection(conn)
+        subject_catalog = catalog
+    return catalog
+
+# Table names offered by the export menu, shared by all admins
+export_table_names = ()
+
+# telegram_id -> student_id and student_id -> [(subject_name, grade), ...]
+student_id_cache = LRUCache(ATTESTATION_CACHE_SIZE)
+attestation_cache = LRUCache(ATTESTATION_CACHE_SIZE)
+attestation_invalidated = LRUCache(ATTESTATION_CACHE_SIZE)
+
+# telegram_id -> group_id and (group_id, date) -> (timetable, calendar day, text); texts are
+# reused while both the timetable and the calendar entry they were built from are current
+student_group_cache = LRUCache(ATTESTATION_CACHE_SIZE)
+schedule_texts = LRUCache(SCHEDULE_TEXT_CACHE_SIZE)
+
+def get_student_group(telegram_id):
+    group_id = student_group_cache.get(telegram_id)
+    if group_id is None:
+        conn = get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT group_id FROM students WHERE telegram_id = %s", (telegram_id,))
+            result = cursor.fetchone()
+        finally:
+            cursor.close()
+            release_connection(conn)
+        if result and result[0] is not None:
+            group_id = result[0]
+            student_group_cache.put(telegram_id, group_id)
+    return group_id
+
+def day_schedule_text(group_id, target_date):
+    timetable = get_group_timetable(group_id)
+    calendar = calendar_day(target_date)
+    cached = schedule_texts.get((group_id, target_date))
+    if cached and cached[0] is timetable and cached[1] is calendar:
+        return cached[2]
+    date_str = target_date.strftime('%d.%m.%Y')
+    classes = classes_on(timetable, calendar)
+    if classes:
+        text = f'\n📅 Расписание на {date_str}:\n'
+        for _, _, _, start_time, end_time, subject_name, class_type in classes:
+            text += f"{start_time:%H:%M} - {end_time:%H:%M}: {subject_name} ({CLASS_TYPE_NAMES.get(class_type, class_type)})\n"
+    elif calendar.note:
+        text = f'\nНа {date_str} занятий нет ({calendar.note}).\n'
+    else:
+        text = f'\nНа {date_str} занятий нет.\n'
+    schedule_texts.put((group_id, target_date), (timetable, calendar, text))
+    return text
+
+INLINE_PERIODS = {'сегодня': 'Сегодня', 'завтра': 'Завтра', 'неделя': 'На неделю'}
+
+# Inline answers are per user, so Telegram caches them per user for cache_time, capped at
+# midnight when "today" changes
+@track_latency()
+@read_only()
+async def handle_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.inline_query
+    text = query.query.strip().lower()
+    periods = [period for word, period in INLINE_PERIODS.items() if word.startswith(text)] or list(INLINE_PERIODS.values())
+    now = datetime.now()
+    group_id = get_student_group(query.from_user.id)
+    if group_id is None:
+        results = [InlineQueryResultArticle(
+            id='unregistered',
+            title='Вы не зарегистрированы',
+            description='Откройте бота и используйте /start для регистрации.',
+            input_message_content=InputTextMessageContent('Чтобы смотреть расписание, зарегистрируйтесь в боте командой /start.'),
+        )]
+        await query.answer(results, cache_time=0, is_personal=True)
+        return
+    results = []
+    for period in periods:
+        target_dates = schedule_period_dates(period, now.date())
+        message = ''.join(day_schedule_text(group_id, target_date) for target_date in target_dates).strip()
+        results.append(InlineQueryResultArticle(
+            id=f'{group_id}-{period}-{target_dates[0]:%Y%m%d}',
+            title=f'Расписание: {period.lower()}',
+            description=message.split('\n', 2)[1] if '\n' in message else message,
+            input_message_content=InputTextMessageContent(message),
+        ))
+    until_midnight = (datetime.combine(now.date() + timedelta(days=1), datetime.min.time()) - now).seconds
+    await query.answer(results, cache_time=min(INLINE_CACHE_TIME, until_midnight), is_personal=True)
+
+def invalidate_attestation(student_id):
+    attestation_cache.pop(student_id)
+    attestation_invalidated.put(student_id, time.monotonic())
+
+def attestation_recently_written(student_id):
+    invalidated_at = attestation_invalidated.get(student_id) if student_id is not None else None
+    return invalidated_at is not None and time.monotonic() - invalidated_at < DB_REPLICA_MAX_LAG
+
+def get_student_attestation(telegram_id):
+    student_id = student_id_cache.get(telegram_id)
+    if student_id is not None:
+        grades = attestation_cache.get(student_id)
+        if grades is not None:
+            return student_id, grades
+
+    # Right after a write a replica may still serve the old grades, don't cache those
+    token = None
+    if attestation_recently_written(student_id):
+        token = db_route.set(None)
+    try:
+        conn = get_connection()
+    finally:
+        if token:
+            db_route.reset(token)
+    on_replica = id(conn) in connection_owners
+    try:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        if student_id is None:
+            cursor.execute("SELECT id FROM students WHERE telegram_id = %s", (telegram_id,))
+            student = cursor.fetchone()
+            if not student:
+                return None, None
             student_id = student['id']
-            cursor.execute("""
-                SELECT sub.name AS subject_name, a.grade
-                FROM attestations a
-                JOIN subjects sub ON a.subject_id = sub.id
-                WHERE a.student_id = %s
-                ORDER BY sub.name
-            """, (student_id,))
-            attestation_rows = cursor.fetchall()
-
-            if attestation_rows:
+            student_id_cache.put(telegram_id, student_id)
+        cursor.execute("""
+            SELECT sub.name AS subject_name, a.grade
+            FROM attestations a
+            JOIN subjects sub ON a.subject_id = sub.id
+            WHERE a.student_id = %s
+            ORDER BY sub.name
+        """, (student_id,))
+        grades = [(row['subject_name'], row['grade']) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+        release_connection(conn)
+
+    # The student id may only be known now, so the write marker is checked again before caching
+    if not (on_replica and attestation_recently_written(student_id)):
+        attestation_cache.put(student_id, grades)
+    return student_id, grades
+
+def update_cached_grade(student_id, subject_name, grade):
+    # Marked even when the grades are not cached, so the next view does not cache them from a lagging replica
+    attestation_invalidated.put(student_id, time.monotonic())
+    grades = attestation_cache.get(student_id)
+    if grades is None:
+        return
+    for idx, (name, _) in enumerate(grades):
+        if name == subject_name:
+            grades[idx] = (name, grade)
+            return
+    # A new subject changes the ordering, let the next view reload it from the DB
+    invalidate_attestation(student_id)
+
+@track_latency()
+@read_only()
+async def view_attestation(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    telegram_id = update.message.from_user.id
+    try:
+        student_id, grades = get_student_attestation(telegram_id)
+
+        if student_id is not None:
+            if grades:
                 response = '📝 Ваша аттестация:\n'
-                for row in attestation_rows:
-                    subject_name = row['subject_name']
-                    grade = row['grade']
+                for subject_name, grade in grades:
                     response += f"{subject_name}: {grade}\n"
                 await update.message.reply_text(response, reply_markup=get_user_menu(telegram_id))
             else:
@@ -468,53 +1757,148 @@ async def view_attestation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"Ошибка в view_attestation: {e}", exc_info=True)
         await update.message.reply_text('Произошла ошибка при получении аттестации.')
-    finally:
-        cursor.close()
-        release_connection(conn)
 
-def get_week_type_for_db(target_date):
-    week_number = target_date.isocalendar()[1]
-    return 'only_even' if week_number % 2 == 0 else 'only_odd'
+# (chat_id, subject_id, class_time) -> message_id of a reminder nobody has answered yet. An entry
+# expires when its class starts and is then deleted from the chat by cleanup_reminders_job; past
+# maxsize the oldest entries are forgotten, leaving those messages in place.
+class ReminderStore:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def put(self, chat_id, subject_id, class_time, message_id):
+        key = (chat_id, subject_id, class_time)
+        self.entries[key] = message_id
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            reminders_evicted.inc()
+
+    def pop(self, chat_id, subject_id, class_time):
+        return self.entries.pop((chat_id, subject_id, class_time), None)
+
+    def pop_expired(self, now):
+        expired = [key for key in self.entries if key[2] <= now]
+        return [(key[0], self.entries.pop(key)) for key in expired]
+
+    def forget(self, chat_ids):
+        for key in [key for key in self.entries if key[0] in chat_ids]:
+            del self.entries[key]
+
+reminders_evicted = Counter('bot_reminders_evicted_total', 'Reminders forgotten because the store was full.')
+reminder_messages = ReminderStore(REMINDER_STORE_SIZE)
+Gauge('bot_reminders_pending', 'Unanswered reminders waiting for cleanup.', lambda: len(reminder_messages.entries))
+
+@track_latency(scheduler_job_duration)
+@bulk_sends()
+async def cleanup_reminders_job(application):
+    expired = reminder_messages.pop_expired(current_time())
+    deleted = 0
+    # Batches of REMINDER_CLEANUP_CONCURRENCY calls, paced to REMINDER_CLEANUP_RATE calls per second
+    for offset in range(0, len(expired), REMINDER_CLEANUP_CONCURRENCY):
+        batch = expired[offset:offset + REMINDER_CLEANUP_CONCURRENCY]
+        started = time.monotonic()
+        results = await asyncio.gather(
+            *(application.bot.delete_message(chat_id=chat_id, message_id=message_id) for chat_id, message_id in batch),
+            return_exceptions=True
+        )
+        deleted += sum(result is True for result in results)
+        await asyncio.sleep(max(0, len(batch) / REMINDER_CLEANUP_RATE - (time.monotonic() - started)))
+    if expired:
+        logger.warning(f"Удалено неотвеченных напоминаний {deleted}/{len(expired)}", extra={'event': 'reminder_cleanup'})
 
-async def schedule_daily_notifications(application):
+@track_latency(scheduler_job_duration)
+async def schedule_daily_notifications(application, group_ids=None):
     try:
         conn = get_connection()
         cursor = conn.cursor()
-        now = datetime.now()
+        now = current_time()
         today = now.date()
-        day_of_week = today.strftime('%A')
-        week_type = get_week_type_for_db(today)
+        day = calendar_day(today)
+        if not day.is_study_day:
+            logger.warning(f"{today} — неучебный день" + (f" ({day.note})" if day.note else "") +
+                           ", уведомления не планируются", extra={'event': 'planning_summary'})
+            return
+        day_of_week, week_type = day.weekday, day.week_type
 
-        logger.warning(f"Планирование уведомлений на {today} ({day_of_week}), неделя {week_type}")
+        logger.info("Планирование уведомлений на %s (%s), неделя %s", today, day_of_week, week_type)
 
+        # group_ids limits planning to groups whose timetable was just re-imported
         cursor.execute("""
-            SELECT s.group_id, s.subject_id, s.start_time, s.class_type
+            SELECT s.group_id, s.subject_id, sub.name, s.start_time, s.class_type
             FROM schedules s
+            JOIN subjects sub ON s.subject_id = sub.id
             WHERE s.day_of_week = %s AND s.week_type IN (%s, 'all')
-        """, (day_of_week, week_type))
+              AND (%s::int[] IS NULL OR s.group_id = ANY(%s::int[]))
+            ORDER BY s.start_time
+        """, (day_of_week, week_type, group_ids, group_ids))
         classes = cursor.fetchall()
-
-        for class_info in classes:
-            group_id, subject_id, start_time, class_type = class_info
+        cursor.execute("""
+            SELECT DISTINCT st.group_id
+            FROM notification_preferences p
+            JOIN students st ON st.id = p.student_id
+            WHERE p.digest
+        """)
+        digest_groups = {row[0] for row in cursor.fetchall()}
+
+        planned_notifications = 0
+        planned_collections = 0
+        planned_digests = 0
+        class_starts = set()
+        # The class time computed here keys every attendance row of the class: the digest creates
+        # them from the same list, so the reminder job finds them and skips digest subscribers
+        day_classes = {}
+        for group_id, subject_id, subject_name, start_time, class_type in classes:
             class_datetime = datetime.combine(today, start_time)
+            day_classes.setdefault(group_id, []).append((subject_id, subject_name, class_datetime, class_type))
 
             notification_time = class_datetime - timedelta(minutes=5)
             if notification_time > now:
                 scheduler.add_job(
                     send_class_notification_job,
                     trigger=DateTrigger(run_date=notification_time),
-                    args=[application, group_id, subject_id, start_time, class_type]
+                    args=[application, group_id, subject_id, class_datetime, class_type]
                 )
-                logger.warning(f"Запланировано уведомление для группы {group_id} по предмету {subject_id} на {notification_time}")
+                planned_notifications += 1
+                class_starts.add(class_datetime)
+                logger.info("Запланировано уведомление для группы %s по предмету %s на %s",
+                            group_id, subject_id, notification_time, extra={'event': 'notification_planned'})
 
             attendance_collection_time = class_datetime + timedelta(minutes=5)
             if attendance_collection_time > now:
                 scheduler.add_job(
                     collect_attendance_job,
                     trigger=DateTrigger(run_date=attendance_collection_time),
-                    args=[application, group_id, subject_id, start_time]
+                    args=[application, group_id, subject_id, class_datetime]
+                )
+                planned_collections += 1
+                logger.info("Запланирован сбор посещаемости для группы %s по предмету %s на %s",
+                            group_id, subject_id, attendance_collection_time, extra={'event': 'collection_planned'})
+
+        # Unanswered reminders of every group are cleaned up in one batch when their classes start.
+        # The ids keep a re-planning after a timetable import from adding a second job per slot.
+        for class_datetime in sorted(class_starts):
+            scheduler.add_job(
+                cleanup_reminders_job,
+                trigger=DateTrigger(run_date=class_datetime),
+                args=[application],
+                id=f'cleanup_reminders_{class_datetime:%Y%m%d%H%M}',
+                replace_existing=True
+            )
+
+        # One morning digest per group with subscribers; once DIGEST_TIME has passed they get per-class reminders instead
+        digest_time = datetime.combine(today, DIGEST_TIME)
+        if digest_time > now:
+            for group_id in sorted(day_classes.keys() & digest_groups):
+                scheduler.add_job(
+                    send_daily_digest_job,
+                    trigger=DateTrigger(run_date=digest_time),
+                    args=[application, group_id, day_classes[group_id]]
                 )
-                logger.warning(f"Запланирован сбор посещаемости для группы {group_id} по предмету {subject_id} на {attendance_collection_time}")
+                planned_digests += 1
+
+        logger.warning(f"Запланировано на {today} ({day_of_week}, {week_type}): уведомлений {planned_notifications}, "
+                       f"сборов посещаемости {planned_collections}, сводок {planned_digests}", extra={'event': 'planning_summary'})
 
     except Exception as e:
         logger.error(f"Ошибка в schedule_daily_notifications: {e}", exc_info=True)
@@ -524,7 +1908,9 @@ async def schedule_daily_notifications(application):
         if conn:
             release_connection(conn)
 
-async def send_class_notification_job(application, group_id, subject_id, start_time, class_type):
+@track_latency(scheduler_job_duration)
+@bulk_sends()
+async def send_class_notification_job(application, group_id, subject_id, class_datetime, class_type):
     try:
         conn = get_connection()
         cursor = conn.cursor()
@@ -532,17 +1918,19 @@ async def send_class_notification_job(application, group_id, subject_id, start_t
         cursor.execute("SELECT name FROM subjects WHERE id = %s", (subject_id,))
         subject_name = cursor.fetchone()[0]
 
-        cursor.execute("SELECT telegram_id, id FROM students WHERE group_id = %s", (group_id,))
+        # Students who already have a row for this class got it in their morning digest
+        cursor.execute("""
+            SELECT s.telegram_id, s.id
+            FROM students s
+            WHERE s.group_id = %s AND s.telegram_id IS NOT NULL AND NOT EXISTS (
+                SELECT 1 FROM temp_attendance ta
+                WHERE ta.student_id = s.id AND ta.subject_id = %s AND ta.class_time = %s
+            )
+        """, (group_id, subject_id, class_datetime))
         students = cursor.fetchall()
 
         # Get class representative and deputy
-        cursor.execute("SELECT telegram_id FROM class_representatives WHERE group_id = %s", (group_id,))
-        starosta_result = cursor.fetchone()
-        cursor.execute("SELECT telegram_id FROM deputy_class_representatives WHERE group_id = %s", (group_id,))
-        deputy_result = cursor.fetchone()
-
-        starosta_telegram_id = starosta_result[0] if starosta_result else None
-        deputy_telegram_id = deputy_result[0] if deputy_result else None
+        starosta_telegram_id, deputy_telegram_id = get_group_representatives(group_id)
 
         class_type_ru = {
             'lecture': 'Лекция',
@@ -550,27 +1938,29 @@ async def send_class_notification_job(application, group_id, subject_id, start_t
             'lab': 'Лабораторная работа'
         }.get(class_type, class_type)
 
+        class_time_ts = int(class_datetime.timestamp())
+        sent = 0
         for telegram_id, student_id in students:
             keyboard = [
-                [InlineKeyboardButton("✅ Буду на паре", callback_data=f'present_{subject_id}_{student_id}')],
-                [InlineKeyboardButton("❌ Отсутствую", callback_data=f'absent_{subject_id}_{student_id}')]
+                [InlineKeyboardButton("✅ Буду на паре", callback_data=f'present_{subject_id}_{student_id}_{class_time_ts}')],
+                [InlineKeyboardButton("❌ Отсутствую", callback_data=f'absent_{subject_id}_{student_id}_{class_time_ts}')]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             try:
                 message = await application.bot.send_message(
                     chat_id=telegram_id,
-                    text=f'Напоминание о начале пары "{subject_name}" ({class_type_ru}) в {start_time.strftime("%H:%M")}.\n'
+                    text=f'Напоминание о начале пары "{subject_name}" ({class_type_ru}) в {class_datetime:%H:%M}.\n'
                          f'Пожалуйста, отметьте свое присутствие.',
                     reply_markup=reply_markup
                 )
-                # Store message ID to delete later
-                context = application.bot_data.setdefault('attendance_messages', {})
-                context[telegram_id] = message.message_id
-                logger.warning(f"Отправлено уведомление пользователю {telegram_id}")
+                # Deleted by cleanup_reminders_job if still unanswered when the class starts
+                reminder_messages.put(telegram_id, subject_id, class_datetime, message.message_id)
+                sent += 1
+                logger.info("Отправлено уведомление пользователю %s", telegram_id, extra={'event': 'reminder_sent'})
             except Exception as e:
-                logger.error(f"Ошибка при отправке сообщения пользователю {telegram_id}: {e}", exc_info=True)
+                logger.error("Ошибка при отправке сообщения пользователю %s: %s", telegram_id, e,
+                             exc_info=True, extra={'event': 'reminder_failed'})
 
-            class_datetime = datetime.combine(datetime.now().date(), start_time)
             try:
                 cursor.execute("""
                     INSERT INTO temp_attendance (student_id, subject_id, class_time)
@@ -588,13 +1978,15 @@ async def send_class_notification_job(application, group_id, subject_id, start_t
                 try:
                     await application.bot.send_message(
                         chat_id=rep_id,
-                        text=f'Напоминание о начале пары "{subject_name}" ({class_type_ru}) в {start_time.strftime("%H:%M")}.',
+                        text=f'Напоминание о начале пары "{subject_name}" ({class_type_ru}) в {class_datetime:%H:%M}.',
                     )
-                    logger.warning(f"Отправлено уведомление старосте/заместителю {rep_id}")
+                    logger.info("Отправлено уведомление старосте/заместителю %s", rep_id, extra={'event': 'reminder_sent'})
                 except Exception as e:
                     logger.error(f"Ошибка при отправке сообщения старосте/заместителю {rep_id}: {e}", exc_info=True)
 
         conn.commit()
+        logger.warning(f"Отправлено напоминаний {sent}/{len(students)} группе {group_id} по предмету {subject_id} "
+                       f"в {class_datetime:%H:%M}", extra={'event': 'reminder_summary'})
 
     except Exception as e:
         logger.error(f"Ошибка в send_class_notification_job: {e}", exc_info=True)
@@ -604,30 +1996,123 @@ async def send_class_notification_job(application, group_id, subject_id, start_t
         if conn:
             release_connection(conn)
 
-async def collect_attendance_job(application, group_id, subject_id, start_time):
+@track_latency(scheduler_job_duration)
+@bulk_sends()
+async def send_daily_digest_job(application, group_id, classes):
     try:
         conn = get_connection()
         cursor = conn.cursor()
-        now = datetime.now()
-        class_time = datetime.combine(now.date(), start_time)
+        today = current_time().date()
 
-        # Get class representative and deputy
-        cursor.execute("SELECT telegram_id FROM class_representatives WHERE group_id = %s", (group_id,))
-        starosta_result = cursor.fetchone()
-        cursor.execute("SELECT telegram_id FROM deputy_class_representatives WHERE group_id = %s", (group_id,))
-        deputy_result = cursor.fetchone()
+        # Attendance rows for the whole day are created up front, so the per-class jobs skip these students
+        cursor.execute("""
+            WITH subscribers AS (
+                SELECT st.id, st.telegram_id
+                FROM students st
+                JOIN notification_preferences p ON p.student_id = st.id
+                WHERE st.group_id = %s AND p.digest AND st.telegram_id IS NOT NULL
+            ), created AS (
+                INSERT INTO temp_attendance (student_id, subject_id, class_time)
+                SELECT sb.id, c.subject_id, c.class_time
+                FROM subscribers sb
+                CROSS JOIN unnest(%s::int[], %s::timestamp[]) AS c(subject_id, class_time)
+                ON CONFLICT DO NOTHING
+            )
+            SELECT telegram_id, id FROM subscribers
+        """, (group_id, [class_info[0] for class_info in classes], [class_info[2] for class_info in classes]))
+        students = cursor.fetchall()
+        conn.commit()
 
-        reps = []
-        if starosta_result:
-            reps.append(starosta_result[0])
-        if deputy_result:
-            reps.append(deputy_result[0])
+        # The text is shared by the whole group, only the callback data differs per student
+        text = f'Расписание на сегодня, {today:%d.%m}:\n'
+        buttons = []
+        for subject_id, subject_name, class_datetime, class_type in classes:
+            text += f'{class_datetime:%H:%M} — {subject_name} ({CLASS_TYPE_NAMES.get(class_type, class_type)})\n'
+            buttons.append((f'{class_datetime:%H:%M}', f'{subject_id}_{{}}_{int(class_datetime.timestamp())}'))
+        text += '\nОтметьте своё присутствие на каждой паре.'
 
-        if reps:
-            cursor.execute("""
-                SELECT ta.student_id, s.first_name, s.last_name, ta.status
-                FROM temp_attendance ta
-                JOIN students s ON ta.student_id = s.id
+        sent = 0
+        for telegram_id, student_id in students:
+            reply_markup = InlineKeyboardMarkup([
+                [InlineKeyboardButton(f"✅ {label}", callback_data=f'digest_present_{suffix.format(student_id)}'),
+                 InlineKeyboardButton(f"❌ {label}", callback_data=f'digest_absent_{suffix.format(student_id)}')]
+                for label, suffix in buttons
+            ])
+            try:
+                await application.bot.send_message(chat_id=telegram_id, text=text, reply_markup=reply_markup)
+                sent += 1
+            except Exception as e:
+                logger.error("Ошибка при отправке сводки пользователю %s: %s", telegram_id, e,
+                             exc_info=True, extra={'event': 'digest_failed'})
+        logger.warning(f"Отправлено сводок {sent}/{len(students)} группе {group_id}, пар {len(classes)}",
+                       extra={'event': 'digest_summary'})
+
+    except Exception as e:
+        logger.error(f"Ошибка в send_daily_digest_job: {e}", exc_info=True)
+    finally:
+        if cursor:
+            cursor.close()
+        if conn:
+            release_connection(conn)
+
+def reminder_settings_markup(digest):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(('• ' if not digest else '') + 'Перед каждой парой', callback_data='reminders_class')],
+        [InlineKeyboardButton(('• ' if digest else '') + f'Утренняя сводка в {DIGEST_TIME:%H:%M}', callback_data='reminders_digest')]
+    ])
+
+@track_latency()
+async def show_reminder_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT coalesce(p.digest, FALSE)
+            FROM students s
+            LEFT JOIN notification_preferences p ON p.student_id = s.id
+            WHERE s.telegram_id = %s
+        """, (update.message.from_user.id,))
+        row = cursor.fetchone()
+        conn.commit()
+    finally:
+        cursor.close()
+        release_connection(conn)
+    if row is None:
+        await update.message.reply_text('Вы не зарегистрированы. Пожалуйста, используйте команду /start для регистрации.')
+        return
+    await update.message.reply_text('Как присылать напоминания о парах?', reply_markup=reminder_settings_markup(row[0]))
+
+def set_reminder_mode(telegram_id, digest):
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO notification_preferences (student_id, digest)
+            SELECT id, %s FROM students WHERE telegram_id = %s
+            ON CONFLICT (student_id) DO UPDATE SET digest = EXCLUDED.digest
+        """, (digest, telegram_id))
+        updated = cursor.rowcount
+        conn.commit()
+    finally:
+        cursor.close()
+        release_connection(conn)
+    return updated > 0
+
+@track_latency(scheduler_job_duration)
+@bulk_sends()
+async def collect_attendance_job(application, group_id, subject_id, class_time):
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+
+        # Get class representative and deputy
+        reps = [rep_id for rep_id in get_group_representatives(group_id) if rep_id]
+
+        if reps:
+            cursor.execute("""
+                SELECT ta.student_id, s.first_name, s.last_name, ta.status
+                FROM temp_attendance ta
+                JOIN students s ON ta.student_id = s.id
                 WHERE ta.subject_id = %s AND ta.class_time = %s AND s.group_id = %s
                 ORDER BY s.last_name, s.first_name
             """, (subject_id, class_time, group_id))
@@ -658,7 +2143,7 @@ async def collect_attendance_job(application, group_id, subject_id, start_time):
                         text=attendance_text,
                         reply_markup=reply_markup
                     )
-                    logger.warning(f"Отправлен список посещаемости старосте/заместителю {rep_id}")
+                    logger.info("Отправлен список посещаемости старосте/заместителю %s", rep_id, extra={'event': 'attendance_list_sent'})
                 except Exception as e:
                     logger.error(f"Ошибка при отправке сообщения старосте/заместителю {rep_id}: {e}", exc_info=True)
 
@@ -672,6 +2157,7 @@ async def collect_attendance_job(application, group_id, subject_id, start_time):
         if conn:
             release_connection(conn)
 
+@track_latency()
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     telegram_id = query.from_user.id
@@ -680,29 +2166,27 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     parts = data.split('_')
 
     if parts[0] in ['present', 'absent']:
-        action, subject_id, student_id = parts
-        subject_id = int(subject_id)
-        student_id = int(student_id)
+        if len(parts) != 4:
+            # Reminder sent before class times were added to the callback data
+            await query.answer('Эта пара уже не отмечается.')
+            return
+        action, subject_id, student_id, class_time_ts = parts[0], int(parts[1]), int(parts[2]), int(parts[3])
+        class_time = datetime.fromtimestamp(class_time_ts)
         status = 'present' if action == 'present' else 'absent'
         await query.answer('Спасибо за ваш ответ.')
         await query.message.delete()
+        reminder_messages.pop(telegram_id, subject_id, class_time)
         conn = get_connection()
         try:
             cursor = conn.cursor()
             cursor.execute("""
-                SELECT class_time FROM temp_attendance
-                WHERE student_id = %s AND subject_id = %s
-            """, (student_id, subject_id))
-            result = cursor.fetchone()
-            if result:
-                class_time = result[0]
-                cursor.execute("""
-                    UPDATE temp_attendance
-                    SET status = %s
-                    WHERE student_id = %s AND subject_id = %s AND class_time = %s
-                """, (status, student_id, subject_id, class_time))
-                conn.commit()
-            else:
+                UPDATE temp_attendance
+                SET status = %s
+                WHERE student_id = %s AND subject_id = %s AND class_time = %s
+            """, (status, student_id, subject_id, class_time))
+            updated = cursor.rowcount
+            conn.commit()
+            if not updated:
                 logger.error(f"Не удалось найти запись в temp_attendance для студента {student_id} и предмета {subject_id}")
         except Exception as e:
             logger.error(f"Ошибка в button_callback (present/absent): {e}", exc_info=True)
@@ -711,19 +2195,69 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             cursor.close()
             release_connection(conn)
         if action == 'absent':
-            context.user_data['awaiting_explanation'] = True
-            context.user_data['subject_id'] = subject_id
-            context.user_data['student_id'] = student_id
+            flow_states.start(telegram_id, ExplanationFlow(student_id=student_id, subject_id=subject_id))
+            await context.bot.send_message(chat_id=telegram_id, text='Введите причину отсутствия.')
+    elif parts[0] == 'digest':
+        action, subject_id, student_id, class_time_ts = parts[1], int(parts[2]), int(parts[3]), int(parts[4])
+        class_time = datetime.fromtimestamp(class_time_ts)
+        conn = get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE temp_attendance
+                SET status = %s
+                WHERE student_id = %s AND subject_id = %s AND class_time = %s
+            """, (action, student_id, subject_id, class_time))
+            updated = cursor.rowcount
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Ошибка в button_callback (digest): {e}", exc_info=True)
+            await query.answer('Произошла ошибка при записи статуса.')
+            return
+        finally:
+            cursor.close()
+            release_connection(conn)
+        if not updated:
+            await query.answer('Эта пара уже не отмечается.')
+            return
+        await query.answer('Спасибо за ваш ответ.')
+        # Drop the answered class from the digest, the message goes away with the last one
+        suffix = f'_{subject_id}_{student_id}_{class_time_ts}'
+        rows = [row for row in query.message.reply_markup.inline_keyboard if not row[0].callback_data.endswith(suffix)]
+        if rows:
+            await query.edit_message_reply_markup(InlineKeyboardMarkup(rows))
+        else:
+            await query.message.delete()
+        if action == 'absent':
+            flow_states.start(telegram_id, ExplanationFlow(student_id=student_id, subject_id=subject_id))
             await context.bot.send_message(chat_id=telegram_id, text='Введите причину отсутствия.')
+    elif parts[0] == 'checkin':
+        session = checkin_sessions.get(get_role_group(telegram_id))
+        if session is None or session.message_id != query.message.message_id:
+            await query.answer('Отметка уже завершена.')
+            return
+        await query.answer('Отметка завершена.')
+        await close_checkin(context.application, session)
+    elif parts[0] == 'reminders':
+        digest = parts[1] == 'digest'
+        try:
+            if not set_reminder_mode(telegram_id, digest):
+                await query.answer('Вы не зарегистрированы.')
+                return
+        except Exception as e:
+            logger.error(f"Ошибка в button_callback (reminders): {e}", exc_info=True)
+            await query.answer('Произошла ошибка при сохранении настройки.')
+            return
+        await query.answer('Настройка сохранена.')
+        try:
+            await query.edit_message_reply_markup(reminder_settings_markup(digest))
+        except BadRequest:
+            # The already selected option was pressed again, the markup is unchanged
+            pass
     elif parts[0] == 'edit':
         idx, subject_id, class_time_ts = int(parts[1]), int(parts[2]), float(parts[3])
         class_time = datetime.fromtimestamp(class_time_ts)
 
-        context.user_data['edit_idx'] = idx
-        context.user_data['subject_id'] = subject_id
-        context.user_data['class_time'] = class_time
-        context.user_data['telegram_id'] = telegram_id
-
         # Fetch student info
         conn = get_connection()
         try:
@@ -828,12 +2362,14 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Handle other callback data
         pass
 
+@track_latency()
 async def handle_explanation(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if context.user_data.get('awaiting_explanation'):
+    telegram_id = update.message.from_user.id
+    flow = flow_states.get(telegram_id, ExplanationFlow)
+    if flow:
         explanation = update.message.text
-        telegram_id = update.message.from_user.id
-        subject_id = context.user_data['subject_id']
-        student_id = context.user_data['student_id']
+        subject_id = flow.subject_id
+        student_id = flow.student_id
         conn = get_connection()
         try:
             cursor = conn.cursor()
@@ -849,28 +2385,14 @@ async def handle_explanation(update: Update, context: ContextTypes.DEFAULT_TYPE)
         finally:
             cursor.close()
             release_connection(conn)
-        context.user_data['awaiting_explanation'] = False
+        flow_states.end(telegram_id, ExplanationFlow)
 
 def is_class_representative():
     def decorator(func):
         async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
             telegram_id = update.effective_user.id
-            conn = get_connection()
-            try:
-                cursor = conn.cursor()
-                cursor.execute("SELECT group_id FROM class_representatives WHERE telegram_id = %s", (telegram_id,))
-                result = cursor.fetchone()
-                if result:
-                    context.user_data['group_id'] = result[0]
-                    return await func(update, context, *args, **kwargs)
-                cursor.execute("SELECT group_id FROM deputy_class_representatives WHERE telegram_id = %s", (telegram_id,))
-                result = cursor.fetchone()
-                if result:
-                    context.user_data['group_id'] = result[0]
-                    return await func(update, context, *args, **kwargs)
-            finally:
-                cursor.close()
-                release_connection(conn)
+            if get_role_group(telegram_id) is not None:
+                return await func(update, context, *args, **kwargs)
             await update.message.reply_text('У вас нет прав для выполнения этой команды.')
         return wrapper
     return decorator
@@ -886,9 +2408,214 @@ def is_admin():
         return wrapper
     return decorator
 
+# A check-in session lives while the representative shows a rotating code during class. Codes
+# are validated against the session in memory, accepted students are written to
+# temp_attendance in batches every CHECKIN_FLUSH_INTERVAL seconds.
+class CheckinSession:
+    __slots__ = ('group_id', 'subject_id', 'subject_name', 'class_time', 'ends_at', 'students', 'codes',
+                 'code_issued_at', 'checked_in', 'pending', 'attempts', 'chat_id', 'message_id')
+
+    def __init__(self, group_id, subject_id, subject_name, class_time, ends_at, students):
+        self.group_id = group_id
+        self.subject_id = subject_id
+        self.subject_name = subject_name
+        self.class_time = class_time
+        self.ends_at = ends_at
+        # telegram_id -> student_id of the group, loaded once when the session starts
+        self.students = students
+        self.codes = (None, None)
+        self.code_issued_at = 0.0
+        self.checked_in = set()
+        self.pending = []
+        self.attempts = {}
+        self.chat_id = None
+        self.message_id = None
+
+    def rotate_code(self):
+        # The previous code stays valid for one more period, for students typing it right at the switch
+        self.codes = (f'{secrets.randbelow(10000):04d}', self.codes[0])
+        self.code_issued_at = time.monotonic()
+
+# group_id -> CheckinSession and telegram_id -> CheckinSession of the student's group
+checkin_sessions = {}
+checkin_participants = {}
+
+def forget_checkin_students(telegram_ids):
+    for telegram_id in telegram_ids:
+        session = checkin_participants.pop(telegram_id, None)
+        if session is None:
+            continue
+        # Pending check-ins of deleted students would fail the foreign key on every flush
+        student_id = session.students.pop(telegram_id)
+        session.checked_in.discard(student_id)
+        session.pending = [pending_id for pending_id in session.pending if pending_id != student_id]
+        session.attempts.pop(telegram_id, None)
+
+def checkin_text(session, bot_username):
+    return (
+        f'📍 Отметка на паре «{session.subject_name}» в {session.class_time:%H:%M}\n\n'
+        f'Код: {session.codes[0]}\n'
+        f'Ссылка: https://t.me/{bot_username}?start={CHECKIN_LINK_PREFIX}{session.codes[0]}\n\n'
+        f'Отметились: {len(session.checked_in)} из {len(session.students)}. '
+        f'Код меняется каждые {CHECKIN_CODE_TTL:g} с.'
+    )
+
+def checkin_markup():
+    return InlineKeyboardMarkup([[InlineKeyboardButton('⏹ Завершить отметку', callback_data='checkin_stop')]])
+
+@is_class_representative()
+@track_latency()
+async def start_checkin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    group_id = get_role_group(update.effective_user.id)
+    session = checkin_sessions.get(group_id)
+    if session is not None:
+        await update.message.reply_text(checkin_text(session, context.bot.username), reply_markup=checkin_markup())
+        return
+    now = current_time()
+    day = calendar_day(now.date())
+    if not day.is_study_day:
+        await update.message.reply_text('Сегодня нет пар.')
+        return
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        # The class in progress or starting within CHECKIN_OPENS_BEFORE
+        cursor.execute("""
+            SELECT s.subject_id, sub.name, s.start_time, s.end_time
+            FROM schedules s
+            JOIN subjects sub ON s.subject_id = sub.id
+            WHERE s.group_id = %s AND s.day_of_week = %s AND s.week_type IN (%s, 'all')
+              AND s.start_time <= %s AND s.end_time > %s
+            ORDER BY s.start_time
+            LIMIT 1
+        """, (group_id, day.weekday, day.week_type, (now + CHECKIN_OPENS_BEFORE).time(), now.time()))
+        current_class = cursor.fetchone()
+        cursor.execute("SELECT telegram_id, id FROM students WHERE group_id = %s AND telegram_id IS NOT NULL", (group_id,))
+        students = dict(cursor.fetchall())
+        conn.commit()
+    except Exception as e:
+        logger.error(f"Ошибка в start_checkin: {e}", exc_info=True)
+        await update.message.reply_text('Произошла ошибка при запуске отметки.')
+        return
+    finally:
+        cursor.close()
+        release_connection(conn)
+    if current_class is None:
+        await update.message.reply_text('Сейчас нет пары, на которой можно отметиться.')
+        return
+
+    subject_id, subject_name, start_time, end_time = current_class
+    session = CheckinSession(group_id, subject_id, subject_name, datetime.combine(now.date(), start_time),
+                             datetime.combine(now.date(), end_time), students)
+    session.rotate_code()
+    message = await update.message.reply_text(checkin_text(session, context.bot.username), reply_markup=checkin_markup())
+    session.chat_id, session.message_id = message.chat_id, message.message_id
+    checkin_sessions[group_id] = session
+    for telegram_id in students:
+        checkin_participants[telegram_id] = session
+    scheduler.add_job(
+        checkin_tick,
+        trigger=IntervalTrigger(seconds=CHECKIN_FLUSH_INTERVAL),
+        args=[context.application, group_id],
+        id=f'checkin_{group_id}',
+        replace_existing=True
+    )
+    logger.warning(f"Отметка на паре {subject_id} группы {group_id} открыта до {end_time:%H:%M}", extra={'event': 'checkin_opened'})
+
+@track_latency()
+async def submit_checkin(update: Update, code):
+    telegram_id = update.message.from_user.id
+    session = checkin_participants.get(telegram_id)
+    if session is None or checkin_sessions.get(session.group_id) is not session:
+        await update.message.reply_text('Сейчас в вашей группе нет открытой отметки.')
+        return
+    student_id = session.students[telegram_id]
+    if student_id in session.checked_in:
+        await update.message.reply_text('Вы уже отмечены на этой паре.')
+        return
+    attempts = session.attempts.get(telegram_id, 0)
+    if attempts >= CHECKIN_MAX_ATTEMPTS:
+        await update.message.reply_text('Слишком много неверных кодов. Обратитесь к старосте.')
+        return
+    if code not in session.codes:
+        session.attempts[telegram_id] = attempts + 1
+        await update.message.reply_text('Неверный или устаревший код.')
+        return
+    session.checked_in.add(student_id)
+    session.pending.append(student_id)
+    await update.message.reply_text(f'✅ Вы отмечены на паре «{session.subject_name}».')
+
+def flush_checkins(session):
+    if not session.pending:
+        return
+    batch, session.pending = session.pending, []
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO temp_attendance (student_id, subject_id, class_time, status)
+            SELECT student_id, %s, %s, 'present' FROM unnest(%s::int[]) AS student_id
+            ON CONFLICT (student_id, subject_id, class_time) DO UPDATE SET status = 'present'
+        """, (session.subject_id, session.class_time, batch))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        # Keep the batch for the next tick
+        session.pending[:0] = batch
+        logger.error(f"Ошибка при записи отметок группы {session.group_id}: {e}", exc_info=True)
+    finally:
+        cursor.close()
+        release_connection(conn)
+
+async def close_checkin(application, session):
+    checkin_sessions.pop(session.group_id, None)
+    for telegram_id in session.students:
+        if checkin_participants.get(telegram_id) is session:
+            del checkin_participants[telegram_id]
+    job = scheduler.get_job(f'checkin_{session.group_id}')
+    if job:
+        job.remove()
+    flush_checkins(session)
+    if session.pending:
+        logger.error(f"Не записаны отметки группы {session.group_id}: {len(session.pending)}", extra={'event': 'checkin_lost'})
+    logger.warning(f"Отметка на паре {session.subject_id} группы {session.group_id} закрыта: "
+                   f"{len(session.checked_in)}/{len(session.students)}", extra={'event': 'checkin_closed'})
+    try:
+        await application.bot.edit_message_text(
+            chat_id=session.chat_id,
+            message_id=session.message_id,
+            text=f'📍 Отметка на паре «{session.subject_name}» в {session.class_time:%H:%M} завершена.\n'
+                 f'Отметились: {len(session.checked_in)} из {len(session.students)}.'
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при закрытии отметки группы {session.group_id}: {e}", exc_info=True)
+
+@track_latency(scheduler_job_duration)
+async def checkin_tick(application, group_id):
+    session = checkin_sessions.get(group_id)
+    if session is None:
+        return
+    flush_checkins(session)
+    if current_time() >= session.ends_at:
+        await close_checkin(application, session)
+        return
+    if time.monotonic() - session.code_issued_at >= CHECKIN_CODE_TTL:
+        session.rotate_code()
+        try:
+            await application.bot.edit_message_text(
+                chat_id=session.chat_id,
+                message_id=session.message_id,
+                text=checkin_text(session, application.bot.username),
+                reply_markup=checkin_markup()
+            )
+        except Exception as e:
+            logger.error(f"Ошибка при смене кода отметки группы {group_id}: {e}", exc_info=True)
+
 @is_class_representative()
+@track_latency()
+@read_only()
 async def view_explanations(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    group_id = context.user_data['group_id']
+    group_id = get_role_group(update.effective_user.id)
     conn = get_connection()
     try:
         cursor = conn.cursor(cursor_factory=RealDictCursor)
@@ -921,8 +2648,9 @@ async def view_explanations(update: Update, context: ContextTypes.DEFAULT_TYPE):
         release_connection(conn)
 
 @is_class_representative()
+@track_latency()
 async def set_attestation(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    group_id = context.user_data['group_id']
+    group_id = get_role_group(update.effective_user.id)
     conn = get_connection()
     try:
         cursor = conn.cursor()
@@ -940,42 +2668,56 @@ async def set_attestation(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if students:
         student_buttons = [KeyboardButton(f"{student[1]} {student[2]}") for student in students]
+        student_buttons.append(KeyboardButton(BULK_GRADES_BUTTON))
         student_buttons.append(KeyboardButton('Назад'))
         keyboard = [student_buttons[i:i+2] for i in range(0, len(student_buttons), 2)]
         reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
         await update.message.reply_text('Выберите студента для выставления аттестации:', reply_markup=reply_markup)
-        context.user_data['students'] = {f"{s[1]} {s[2]}": s[0] for s in students}
+        flow_states.start(update.effective_user.id, AttestationFlow(group_id=group_id))
         return SELECT_STUDENT
     else:
         await update.message.reply_text('В вашей группе нет студентов.')
         return ConversationHandler.END
 
+@track_latency()
 async def select_student(update: Update, context: ContextTypes.DEFAULT_TYPE):
     selected_student = update.message.text.strip()
     if selected_student == 'Назад':
         await update.message.reply_text('Операция отменена.', reply_markup=get_user_menu(update.message.from_user.id))
         return ConversationHandler.END
-    student_id = context.user_data['students'].get(selected_student)
+    flow = flow_states.get(update.message.from_user.id, AttestationFlow)
+    if flow is None:
+        return await flow_expired(update)
+    if selected_student == BULK_GRADES_BUTTON:
+        return await bulk_attestation_start(update, context)
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id FROM students WHERE group_id = %s AND first_name || ' ' || last_name = %s
+        """, (flow.group_id, selected_student))
+        student = cursor.fetchone()
+    except Exception as e:
+        logger.error(f"Ошибка в select_student: {e}", exc_info=True)
+        await update.message.reply_text('Произошла ошибка при получении списка студентов.')
+        return ConversationHandler.END
+    finally:
+        cursor.close()
+        release_connection(conn)
 
-    if student_id:
-        context.user_data['selected_student_id'] = student_id
-        conn = get_connection()
+    if student:
         try:
-            cursor = conn.cursor(cursor_factory=RealDictCursor)
-            cursor.execute("SELECT id, name FROM subjects ORDER BY name ASC")
-            subjects = cursor.fetchall()
+            subjects = get_group_curriculum(flow.group_id) or get_subject_catalog()
         except Exception as e:
             logger.error(f"Ошибка в select_student: {e}", exc_info=True)
             await update.message.reply_text('Произошла ошибка при получении списка предметов.')
             return ConversationHandler.END
-        finally:
-            cursor.close()
-            release_connection(conn)
 
         if subjects:
-            context.user_data['subjects'] = subjects
-            context.user_data['current_subject_index'] = 0
-            first_subject = subjects[0]['name']
+            flow.student_id = student[0]
+            flow.subjects = subjects
+            flow.subject_index = 0
+            first_subject = subjects[0][1]
             keyboard = [[KeyboardButton('Назад')]]
             reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
             await update.message.reply_text(f'Введите оценку для предмета "{first_subject}":', reply_markup=reply_markup)
@@ -987,18 +2729,22 @@ async def select_student(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text('Пожалуйста, выберите студента из списка.')
         return SELECT_STUDENT
 
+@track_latency()
 async def enter_grade(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     if text == 'Назад':
         await set_attestation(update, context)
         return SELECT_STUDENT
+    flow = flow_states.get(update.message.from_user.id, AttestationFlow)
+    if flow is None or flow.subjects is None:
+        return await flow_expired(update)
     try:
         grade = int(text)
         if grade < 2 or grade > 5:
             await update.message.reply_text('Пожалуйста, введите оценку от 2 до 5 или нажмите "Назад".')
             return ENTER_GRADE
-        student_id = context.user_data['selected_student_id']
-        subject_id = context.user_data['subjects'][context.user_data['current_subject_index']]['id']
+        student_id = flow.student_id
+        subject_id, subject_name = flow.subjects[flow.subject_index]
 
         conn = get_connection()
         try:
@@ -1015,6 +2761,7 @@ async def enter_grade(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     WHERE student_id=%s AND subject_id=%s
                 """, (grade, student_id, subject_id))
             conn.commit()
+            update_cached_grade(student_id, subject_name, grade)
         except Exception as e:
             conn.rollback()
             logger.error(f"Ошибка в enter_grade: {e}", exc_info=True)
@@ -1024,35 +2771,254 @@ async def enter_grade(update: Update, context: ContextTypes.DEFAULT_TYPE):
             cursor.close()
             release_connection(conn)
 
-        context.user_data['current_subject_index'] += 1
-        if context.user_data['current_subject_index'] < len(context.user_data['subjects']):
-            next_subject = context.user_data['subjects'][context.user_data['current_subject_index']]['name']
+        flow.subject_index += 1
+        if flow.subject_index < len(flow.subjects):
+            next_subject = flow.subjects[flow.subject_index][1]
             keyboard = [[KeyboardButton('Назад')]]
             reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
             await update.message.reply_text(f'Введите оценку для предмета "{next_subject}":', reply_markup=reply_markup)
             return ENTER_GRADE
         else:
+            flow_states.end(update.message.from_user.id, AttestationFlow)
             await update.message.reply_text('Все оценки успешно выставлены.', reply_markup=get_user_menu(update.message.from_user.id))
             return ConversationHandler.END
     except ValueError:
         await update.message.reply_text('Пожалуйста, введите корректное числовое значение оценки или нажмите "Назад".')
         return ENTER_GRADE
 
+def group_student_names(cursor, group_id):
+    cursor.execute("""
+        SELECT first_name || ' ' || last_name, id FROM students WHERE group_id = %s
+    """, (group_id,))
+    return dict(cursor.fetchall())
+
+async def bulk_attestation_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    flow = flow_states.get(update.message.from_user.id, AttestationFlow)
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        subjects = get_group_curriculum(flow.group_id) or get_subject_catalog()
+        students = group_student_names(cursor, flow.group_id)
+        cursor.execute("""
+            SELECT student_id, subject_id, grade FROM attestations
+            WHERE student_id = ANY(%s)
+        """, (list(students.values()),))
+        existing = {(student_id, subject_id): grade for student_id, subject_id, grade in cursor.fetchall()}
+    except Exception as e:
+        logger.error(f"Ошибка в bulk_attestation_start: {e}", exc_info=True)
+        await update.message.reply_text('Произошла ошибка при подготовке таблицы оценок.')
+        return ConversationHandler.END
+    finally:
+        cursor.close()
+        release_connection(conn)
+
+    if not subjects:
+        await update.message.reply_text('Список предметов пуст.')
+        return ConversationHandler.END
+
+    flow.subjects = subjects
+
+    # Template pre-filled with current grades, so the representative only edits cells
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=';')
+    writer.writerow(['Студент'] + [name for _, name in subjects])
+    for student_name, student_id in students.items():
+        writer.writerow([student_name] + [existing.get((student_id, subject_id), '') for subject_id, _ in subjects])
+    document = io.BytesIO(buffer.getvalue().encode('utf-8-sig'))
+    document.name = 'attestation.csv'
+
+    keyboard = [[KeyboardButton('Назад')]]
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    await update.message.reply_document(
+        document=document,
+        caption='Текущие оценки группы.',
+    )
+    await update.message.reply_text(
+        'Заполните таблицу и отправьте её CSV-файлом или вставьте текстом.\n'
+        'Первая строка — "Студент" и названия предметов, далее по строке на студента. '
+        'Разделитель — ";", "," или табуляция; пустые ячейки пропускаются, оценки от 2 до 5.',
+        reply_markup=reply_markup
+    )
+    return BULK_GRADES
+
+def read_csv_rows(text):
+    lines = [line for line in text.splitlines() if line.strip()]
+    if not lines:
+        return []
+    try:
+        delimiter = csv.Sniffer().sniff(lines[0], delimiters=';,\t').delimiter
+    except csv.Error:
+        delimiter = ';'
+    return list(csv.reader(lines, delimiter=delimiter))
+
+async def download_text_document(document):
+    file = await document.get_file()
+    content = bytes(await file.download_as_bytearray())
+    try:
+        return content.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        # Excel on Russian Windows saves CSV in cp1251
+        return content.decode('cp1251', errors='replace')
+
+def parse_grade_matrix(text, students, subjects):
+    rows = read_csv_rows(text)
+    if len(rows) < 2:
+        return [], ['Таблица должна содержать заголовок и хотя бы одну строку с оценками.']
+
+    student_lookup = {}
+    for name, student_id in students.items():
+        student_lookup[name.lower()] = student_id
+        student_lookup[' '.join(reversed(name.split(' ', 1))).lower()] = student_id
+    subject_lookup = {name.strip().lower(): subject_id for name, subject_id in subjects.items()}
+
+    errors = []
+    header = [cell.strip() for cell in rows[0]]
+    columns = []
+    for cell in header[1:]:
+        subject_id = subject_lookup.get(cell.lower())
+        if subject_id is None and cell:
+            errors.append(f'Неизвестный предмет: "{cell}"')
+        columns.append(subject_id)
+
+    grades = {}
+    seen_students = set()
+    for line_no, row in enumerate(rows[1:], start=2):
+        student_name = row[0].strip() if row else ''
+        student_id = student_lookup.get(' '.join(student_name.split()).lower())
+        if student_id is None:
+            errors.append(f'Строка {line_no}: студент "{student_name}" не найден в группе')
+            continue
+        if student_id in seen_students:
+            errors.append(f'Строка {line_no}: студент "{student_name}" указан повторно')
+            continue
+        seen_students.add(student_id)
+        for column, cell in enumerate(row[1:]):
+            cell = cell.strip()
+            if not cell or cell == '-':
+                continue
+            if column >= len(columns):
+                errors.append(f'Строка {line_no}: лишнее значение "{cell}"')
+                break
+            if columns[column] is None:
+                continue
+            if not cell.isdigit() or not 2 <= int(cell) <= 5:
+                errors.append(f'Строка {line_no}, "{header[column + 1]}": неверная оценка "{cell}"')
+                continue
+            grades[(student_id, columns[column])] = int(cell)
+
+    return [(student_id, subject_id, grade) for (student_id, subject_id), grade in grades.items()], errors
+
+def apply_grade_matrix(entries):
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT student_id, subject_id, grade FROM attestations
+            WHERE student_id = ANY(%s)
+            FOR UPDATE
+        """, (list({student_id for student_id, _, _ in entries}),))
+        existing = {(student_id, subject_id): grade for student_id, subject_id, grade in cursor.fetchall()}
+        changes = [entry for entry in entries if existing.get(entry[:2]) != entry[2]]
+        if changes:
+            execute_values(cursor, """
+                INSERT INTO attestations (student_id, subject_id, grade)
+                VALUES %s
+                ON CONFLICT (student_id, subject_id) DO UPDATE SET grade = EXCLUDED.grade
+            """, changes)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        release_connection(conn)
+
+    added = sum(1 for entry in changes if entry[:2] not in existing)
+    for student_id in {student_id for student_id, _, _ in changes}:
+        invalidate_attestation(student_id)
+    return added, len(changes) - added, len(entries) - len(changes)
+
+@track_latency()
+async def handle_bulk_grades(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    if message.text and message.text.strip() == 'Назад':
+        await set_attestation(update, context)
+        return SELECT_STUDENT
+
+    if message.document:
+        if message.document.file_size and message.document.file_size > BULK_FILE_MAX_SIZE:
+            await message.reply_text('Файл слишком большой.')
+            return BULK_GRADES
+        text = await download_text_document(message.document)
+    elif message.text:
+        text = message.text
+    else:
+        await message.reply_text('Отправьте таблицу CSV-файлом или текстом.')
+        return BULK_GRADES
+
+    flow = flow_states.get(message.from_user.id, AttestationFlow)
+    if flow is None or flow.subjects is None:
+        return await flow_expired(update)
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        students = group_student_names(cursor, flow.group_id)
+    except Exception as e:
+        logger.error(f"Ошибка в handle_bulk_grades: {e}", exc_info=True)
+        await message.reply_text('Произошла ошибка при получении списка студентов.')
+        return BULK_GRADES
+    finally:
+        cursor.close()
+        release_connection(conn)
+    subjects = {name: subject_id for subject_id, name in flow.subjects}
+    entries, errors = parse_grade_matrix(text, students, subjects)
+    if errors:
+        shown = '\n'.join(errors[:20])
+        more = f'\n... и ещё {len(errors) - 20}' if len(errors) > 20 else ''
+        await message.reply_text(f'Таблица не принята, исправьте ошибки:\n{shown}{more}')
+        return BULK_GRADES
+    if not entries:
+        await message.reply_text('В таблице нет оценок.')
+        return BULK_GRADES
+
+    try:
+        added, changed, unchanged = apply_grade_matrix(entries)
+    except Exception as e:
+        logger.error(f"Ошибка в handle_bulk_grades: {e}", exc_info=True)
+        await message.reply_text('Произошла ошибка при сохранении оценок. Ни одна оценка не изменена.')
+        return BULK_GRADES
+
+    flow_states.end(message.from_user.id, AttestationFlow)
+    await message.reply_text(
+        f'Оценки сохранены.\nДобавлено: {added}\nИзменено: {changed}\nБез изменений: {unchanged}',
+        reply_markup=get_user_menu(message.from_user.id)
+    )
+    return ConversationHandler.END
+
 @is_class_representative()
 async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text('Введите сообщение для рассылки:')
-    context.user_data['awaiting_broadcast'] = True
+    flow_states.start(update.effective_user.id, BroadcastFlow())
     return BROADCAST_MESSAGE
 
+@track_latency()
 async def handle_broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if context.user_data.get('awaiting_broadcast'):
-        message = update.message.text
-        group_id = context.user_data['group_id']
-        conn = get_connection()
+    sender_id = update.message.from_user.id
+    if flow_states.get(sender_id, BroadcastFlow) is None:
+        return await flow_expired(update)
+    group_id = get_role_group(sender_id)
+    if group_id is None:
+        flow_states.end(sender_id, BroadcastFlow)
+        await update.message.reply_text('У вас нет прав для выполнения этой команды.')
+        return ConversationHandler.END
+    message = update.message.text
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT telegram_id FROM students WHERE group_id = %s AND telegram_id IS NOT NULL", (group_id,))
+        students = cursor.fetchall()
+        token = http_route.set('bulk')
         try:
-            cursor = conn.cursor()
-            cursor.execute("SELECT telegram_id FROM students WHERE group_id = %s", (group_id,))
-            students = cursor.fetchall()
             for (telegram_id,) in students:
                 try:
                     await context.bot.send_message(
@@ -1061,132 +3027,851 @@ async def handle_broadcast_message(update: Update, context: ContextTypes.DEFAULT
                     )
                 except Exception as e:
                     logger.error(f"Ошибка при отправке сообщения пользователю {telegram_id}: {e}", exc_info=True)
-            await update.message.reply_text('Сообщение отправлено всем членам группы.', reply_markup=get_user_menu(update.message.from_user.id))
-            context.user_data['awaiting_broadcast'] = False
-            return ConversationHandler.END
-        except Exception as e:
-            logger.error(f"Ошибка в handle_broadcast_message: {e}", exc_info=True)
-            await update.message.reply_text('Произошла ошибка при отправке сообщения.')
         finally:
-            cursor.close()
-            release_connection(conn)
+            http_route.reset(token)
+        await update.message.reply_text('Сообщение отправлено всем членам группы.', reply_markup=get_user_menu(update.message.from_user.id))
+        flow_states.end(sender_id, BroadcastFlow)
+        return ConversationHandler.END
+    except Exception as e:
+        logger.error(f"Ошибка в handle_broadcast_message: {e}", exc_info=True)
+        await update.message.reply_text('Произошла ошибка при отправке сообщения.')
+    finally:
+        cursor.close()
+        release_connection(conn)
 
 @is_admin()
 async def assign_representative(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text('Введите Telegram ID пользователя для назначения старостой:')
-    context.user_data['awaiting_representative_id'] = True
+    flow_states.start(update.effective_user.id, RoleAssignmentFlow(table='class_representatives'))
     return ASSIGN_REPRESENTATIVE
 
+@track_latency()
 async def handle_assign_representative(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if context.user_data.get('awaiting_representative_id'):
+    sender_id = update.message.from_user.id
+    flow = flow_states.get(sender_id, RoleAssignmentFlow)
+    if flow is None or flow.table != 'class_representatives':
+        return await flow_expired(update)
+    try:
+        telegram_id = int(update.message.text)
+        conn = get_connection()
         try:
-            telegram_id = int(update.message.text)
-            conn = get_connection()
-            try:
-                cursor = conn.cursor()
-                cursor.execute("SELECT group_id FROM students WHERE telegram_id = %s", (telegram_id,))
-                result = cursor.fetchone()
-                if result:
-                    group_id = result[0]
-                    try:
-                        cursor.execute("""
-                            INSERT INTO class_representatives (telegram_id, group_id)
-                            VALUES (%s, %s)
-                        """, (telegram_id, group_id))
-                    except psycopg2.errors.UniqueViolation:
-                        conn.rollback()
-                        cursor.execute("""
-                            UPDATE class_representatives SET group_id=%s
-                            WHERE telegram_id=%s
-                        """, (group_id, telegram_id))
-                    conn.commit()
-                    await update.message.reply_text('Пользователь назначен старостой группы.', reply_markup=get_user_menu(update.message.from_user.id))
-                else:
-                    await update.message.reply_text('Студент с таким Telegram ID не найден.')
-            except Exception as e:
-                conn.rollback()
-                logger.error(f"Ошибка в handle_assign_representative: {e}", exc_info=True)
-                await update.message.reply_text('Произошла ошибка при назначении старосты.')
-            finally:
-                cursor.close()
-                release_connection(conn)
-        except ValueError:
-            await update.message.reply_text('Пожалуйста, введите корректный Telegram ID.')
-        context.user_data['awaiting_representative_id'] = False
-        return ConversationHandler.END
+            cursor = conn.cursor()
+            cursor.execute("SELECT group_id FROM students WHERE telegram_id = %s", (telegram_id,))
+            result = cursor.fetchone()
+            if result:
+                group_id = result[0]
+                try:
+                    cursor.execute("""
+                        INSERT INTO class_representatives (telegram_id, group_id)
+                        VALUES (%s, %s)
+                    """, (telegram_id, group_id))
+                except psycopg2.errors.UniqueViolation:
+                    conn.rollback()
+                    cursor.execute("""
+                        UPDATE class_representatives SET group_id=%s
+                        WHERE telegram_id=%s
+                    """, (group_id, telegram_id))
+                conn.commit()
+                apply_role_change('class_representatives', new={'telegram_id': telegram_id, 'group_id': group_id})
+                await update.message.reply_text('Пользователь назначен старостой группы.', reply_markup=get_user_menu(update.message.from_user.id))
+            else:
+                await update.message.reply_text('Студент с таким Telegram ID не найден.')
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Ошибка в handle_assign_representative: {e}", exc_info=True)
+            await update.message.reply_text('Произошла ошибка при назначении старосты.')
+        finally:
+            cursor.close()
+            release_connection(conn)
+    except ValueError:
+        await update.message.reply_text('Пожалуйста, введите корректный Telegram ID.')
+    flow_states.end(sender_id, RoleAssignmentFlow)
+    return ConversationHandler.END
 
 @is_class_representative()
 async def assign_deputy(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text('Введите Telegram ID пользователя для назначения заместителем старосты:')
-    context.user_data['awaiting_deputy_id'] = True
+    flow_states.start(update.effective_user.id, RoleAssignmentFlow(table='deputy_class_representatives'))
     return ASSIGN_DEPUTY
 
+@track_latency()
 async def handle_assign_deputy(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if context.user_data.get('awaiting_deputy_id'):
+    sender_id = update.message.from_user.id
+    flow = flow_states.get(sender_id, RoleAssignmentFlow)
+    if flow is None or flow.table != 'deputy_class_representatives':
+        return await flow_expired(update)
+    try:
+        telegram_id = int(update.message.text)
+        group_id = get_role_group(sender_id)
+        conn = get_connection()
         try:
-            telegram_id = int(update.message.text)
-            group_id = context.user_data['group_id']
-            conn = get_connection()
-            try:
-                cursor = conn.cursor()
-                cursor.execute("SELECT id FROM students WHERE telegram_id = %s AND group_id = %s", (telegram_id, group_id))
-                result = cursor.fetchone()
-                if result:
-                    try:
-                        cursor.execute("""
-                            INSERT INTO deputy_class_representatives (telegram_id, group_id)
-                            VALUES (%s, %s)
-                        """, (telegram_id, group_id))
-                    except psycopg2.errors.UniqueViolation:
-                        conn.rollback()
-                        cursor.execute("""
-                            UPDATE deputy_class_representatives SET group_id=%s
-                            WHERE telegram_id=%s
-                        """, (group_id, telegram_id))
-                    conn.commit()
-                    await update.message.reply_text('Пользователь назначен заместителем старосты группы.', reply_markup=get_user_menu(update.message.from_user.id))
-                else:
-                    await update.message.reply_text('Студент с таким Telegram ID не найден в вашей группе.')
-            except Exception as e:
-                conn.rollback()
-                logger.error(f"Ошибка в handle_assign_deputy: {e}", exc_info=True)
-                await update.message.reply_text('Произошла ошибка при назначении заместителя старосты.')
-            finally:
-                cursor.close()
-                release_connection(conn)
-        except ValueError:
-            await update.message.reply_text('Пожалуйста, введите корректный Telegram ID.')
-        context.user_data['awaiting_deputy_id'] = False
-        return ConversationHandler.END
+            cursor = conn.cursor()
+            cursor.execute("SELECT id FROM students WHERE telegram_id = %s AND group_id = %s", (telegram_id, group_id))
+            result = cursor.fetchone()
+            if result:
+                try:
+                    cursor.execute("""
+                        INSERT INTO deputy_class_representatives (telegram_id, group_id)
+                        VALUES (%s, %s)
+                    """, (telegram_id, group_id))
+                except psycopg2.errors.UniqueViolation:
+                    conn.rollback()
+                    cursor.execute("""
+                        UPDATE deputy_class_representatives SET group_id=%s
+                        WHERE telegram_id=%s
+                    """, (group_id, telegram_id))
+                conn.commit()
+                apply_role_change('deputy_class_representatives', new={'telegram_id': telegram_id, 'group_id': group_id})
+                await update.message.reply_text('Пользователь назначен заместителем старосты группы.', reply_markup=get_user_menu(update.message.from_user.id))
+            else:
+                await update.message.reply_text('Студент с таким Telegram ID не найден в вашей группе.')
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Ошибка в handle_assign_deputy: {e}", exc_info=True)
+            await update.message.reply_text('Произошла ошибка при назначении заместителя старосты.')
+        finally:
+            cursor.close()
+            release_connection(conn)
+    except ValueError:
+        await update.message.reply_text('Пожалуйста, введите корректный Telegram ID.')
+    flow_states.end(sender_id, RoleAssignmentFlow)
+    return ConversationHandler.END
 
 @is_admin()
 async def clean_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    keyboard = [
+        ['Группа', 'Год выпуска'],
+        ['Все студенты', 'Назад']
+    ]
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+    await update.message.reply_text('Каких студентов удалить? Их данные будут перенесены в архив.', reply_markup=reply_markup)
+    flow_states.start(update.effective_user.id, PurgeFlow())
+    return PURGE_SELECT_SCOPE
+
+async def handle_purge_scope(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip()
+    if text == 'Назад':
+        await update.message.reply_text('Удаление отменено.', reply_markup=get_user_menu(update.message.from_user.id))
+        return ConversationHandler.END
+    flow = flow_states.get(update.message.from_user.id, PurgeFlow)
+    if flow is None:
+        return await flow_expired(update)
+    if text == 'Группа':
+        conn = get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT name FROM groups ORDER BY name")
+            groups = cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Ошибка в handle_purge_scope: {e}", exc_info=True)
+            await update.message.reply_text('Произошла ошибка при получении списка групп.')
+            return ConversationHandler.END
+        finally:
+            cursor.close()
+            release_connection(conn)
+        group_buttons = [KeyboardButton(group[0]) for group in groups]
+        group_buttons.append(KeyboardButton('Назад'))
+        keyboard = [group_buttons[i:i+2] for i in range(0, len(group_buttons), 2)]
+        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+        flow.scope = 'group'
+        await update.message.reply_text('Выберите группу:', reply_markup=reply_markup)
+        return PURGE_SELECT_TARGET
+    if text == 'Год выпуска':
+        flow.scope = 'year'
+        await update.message.reply_text('Введите год выпуска, например 2025:', reply_markup=ReplyKeyboardMarkup([['Назад']], resize_keyboard=True))
+        return PURGE_SELECT_TARGET
+    if text == 'Все студенты':
+        flow.scope = 'all'
+        flow.value = None
+        return await confirm_purge(update, flow)
+    await update.message.reply_text('Пожалуйста, выберите вариант из списка.')
+    return PURGE_SELECT_SCOPE
+
+async def handle_purge_target(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip()
+    if text == 'Назад':
+        return await clean_users(update, context)
+    flow = flow_states.get(update.message.from_user.id, PurgeFlow)
+    if flow is None:
+        return await flow_expired(update)
+    if flow.scope == 'year':
+        if not text.isdigit():
+            await update.message.reply_text('Пожалуйста, введите год числом.')
+            return PURGE_SELECT_TARGET
+        flow.value = int(text)
+    else:
+        conn = get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id FROM groups WHERE name = %s", (text,))
+            result = cursor.fetchone()
+        finally:
+            cursor.close()
+            release_connection(conn)
+        if not result:
+            await update.message.reply_text('Группа не найдена. Выберите группу из списка.')
+            return PURGE_SELECT_TARGET
+        flow.value = result[0]
+    return await confirm_purge(update, flow)
+
+def purge_condition(scope, value):
+    if scope == 'group':
+        return "group_id = %s", (value,)
+    if scope == 'year':
+        return "group_id IN (SELECT id FROM groups WHERE graduation_year = %s)", (value,)
+    return "TRUE", ()
+
+async def confirm_purge(update: Update, flow: PurgeFlow):
+    condition, params = purge_condition(flow.scope, flow.value)
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT count(*) FROM students WHERE {condition}", params)
+        total = cursor.fetchone()[0]
+    except Exception as e:
+        logger.error(f"Ошибка в confirm_purge: {e}", exc_info=True)
+        await update.message.reply_text('Произошла ошибка при подсчёте студентов.')
+        return ConversationHandler.END
+    finally:
+        cursor.close()
+        release_connection(conn)
+    if not total:
+        await update.message.reply_text('Студенты не найдены.', reply_markup=get_user_menu(update.message.from_user.id))
+        return ConversationHandler.END
+    flow.total = total
+    reply_markup = ReplyKeyboardMarkup([['Подтвердить', 'Назад']], resize_keyboard=True, one_time_keyboard=True)
+    await update.message.reply_text(f'Будет удалено студентов: {total}. Подтвердить?', reply_markup=reply_markup)
+    return PURGE_CONFIRM
+
+def purge_students_batch(scope, value):
+    condition, params = purge_condition(scope, value)
     conn = get_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM students")
+        # Give up quickly instead of queueing behind live attendance writes
+        cursor.execute("SET LOCAL lock_timeout = '5s'")
+        cursor.execute(f"""
+            SELECT id, telegram_id FROM students
+            WHERE {condition}
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        """, params + (PURGE_BATCH_SIZE,))
+        rows = cursor.fetchall()
+        if not rows:
+            conn.commit()
+            return [], []
+        student_ids = [row[0] for row in rows]
+        telegram_ids = [row[1] for row in rows if row[1] is not None]
+        for table in ('attestations', 'explanations', 'attendance_journal'):
+            cursor.execute(f"""
+                WITH moved AS (DELETE FROM {table} WHERE student_id = ANY(%s) RETURNING *)
+                INSERT INTO archive_{table} SELECT *, now() FROM moved
+            """, (student_ids,))
+        for table in ('temp_attendance', 'notification_preferences'):
+            cursor.execute(f"DELETE FROM {table} WHERE student_id = ANY(%s)", (student_ids,))
+        for table in ROLE_TABLES:
+            cursor.execute(f"DELETE FROM {table} WHERE telegram_id = ANY(%s)", (telegram_ids,))
+        cursor.execute("""
+            WITH moved AS (DELETE FROM students WHERE id = ANY(%s) RETURNING *)
+            INSERT INTO archive_students SELECT *, now() FROM moved
+        """, (student_ids,))
         conn.commit()
-        await update.message.reply_text('Все пользователи были удалены.')
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        release_connection(conn)
+    return student_ids, telegram_ids
+
+def forget_purged_students(student_ids, telegram_ids):
+    for telegram_id in telegram_ids:
+        student_id_cache.pop(telegram_id)
+        student_group_cache.pop(telegram_id)
+        for table in ROLE_TABLES:
+            apply_role_change(table, old={'telegram_id': telegram_id})
+    purged_telegram_ids = set(telegram_ids)
+    reminder_messages.forget(purged_telegram_ids)
+    flow_states.forget(purged_telegram_ids)
+    forget_checkin_students(purged_telegram_ids)
+    for student_id in student_ids:
+        invalidate_attestation(student_id)
+
+@track_latency()
+async def handle_purge_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip()
+    if text != 'Подтвердить':
+        flow_states.end(update.message.from_user.id, PurgeFlow)
+        await update.message.reply_text('Удаление отменено.', reply_markup=get_user_menu(update.message.from_user.id))
+        return ConversationHandler.END
+
+    flow = flow_states.get(update.message.from_user.id, PurgeFlow)
+    if flow is None or flow.total is None:
+        return await flow_expired(update)
+    flow_states.end(update.message.from_user.id, PurgeFlow)
+    progress = await update.message.reply_text(f'Удаление: 0 из {flow.total}...')
+    # The batches run in the background so the admin's intake slot and update lock are released now
+    context.application.create_task(purge_students(update, flow.scope, flow.value, flow.total, progress), update=update)
+    return ConversationHandler.END
+
+async def purge_students(update: Update, scope, value, total, progress):
+    purged = 0
+    last_report = time.monotonic()
+    while True:
+        try:
+            student_ids, telegram_ids = await asyncio.to_thread(purge_students_batch, scope, value)
+        except Exception as e:
+            logger.error(f"Ошибка в purge_students: {e}", exc_info=True)
+            await update.message.reply_text(
+                f'Удаление прервано после {purged} из {total} студентов. '
+                'Уже удалённые данные сохранены в архиве, можно запустить удаление повторно.',
+                reply_markup=get_user_menu(update.message.from_user.id)
+            )
+            return
+        if not student_ids:
+            break
+        forget_purged_students(student_ids, telegram_ids)
+        purged += len(student_ids)
+        if time.monotonic() - last_report >= 2:
+            last_report = time.monotonic()
+            try:
+                await progress.edit_text(f'Удаление: {purged} из {total}...')
+            except Exception as e:
+                logger.error(f"Ошибка при обновлении прогресса удаления: {e}", exc_info=True)
+
+    await progress.edit_text(f'Удалено студентов: {purged}. Их данные перенесены в архив.')
+    await update.message.reply_text('Готово.', reply_markup=get_user_menu(update.message.from_user.id))
+
+@is_admin()
+async def import_roster_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    keyboard = [[KeyboardButton('Назад')]]
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    await update.message.reply_text(
+        'Отправьте CSV-файл со списком студентов: фамилия, имя, группа (по строке на студента, '
+        'заголовок необязателен). В ответ придёт файл со ссылками-приглашениями для привязки Telegram.',
+        reply_markup=reply_markup
+    )
+    return IMPORT_ROSTER
+
+def parse_roster(text):
+    rows = read_csv_rows(text)
+    if rows and rows[0] and rows[0][0].strip().lower() == 'фамилия':
+        rows = rows[1:]
+    roster = []
+    errors = []
+    for line_no, row in enumerate(rows, start=1):
+        cells = [' '.join(cell.split()) for cell in row]
+        if len(cells) < 3 or not all(cells[:3]):
+            errors.append(f'Строка {line_no}: нужны фамилия, имя и группа')
+            continue
+        last_name, first_name, group_name = cells[:3]
+        roster.append((first_name, last_name, group_name, secrets.token_urlsafe(8)))
+    return roster, errors
+
+def import_roster(roster):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(roster)
+    buffer.seek(0)
+
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TEMP TABLE roster_import (
+                first_name VARCHAR(50),
+                last_name VARCHAR(50),
+                group_name VARCHAR(50),
+                invite_code VARCHAR(16)
+            ) ON COMMIT DROP
+        """)
+        cursor.copy_expert("COPY roster_import FROM STDIN WITH (FORMAT csv)", buffer)
+        cursor.execute("""
+            SELECT DISTINCT r.group_name FROM roster_import r
+            LEFT JOIN groups g ON g.name = r.group_name
+            WHERE g.id IS NULL
+        """)
+        unknown_groups = [row[0] for row in cursor.fetchall()]
+        if unknown_groups:
+            conn.rollback()
+            return None, unknown_groups
+        # Skip students that already exist in the group (by name), including repeats in the file
+        cursor.execute("""
+            INSERT INTO students (first_name, last_name, group_id, invite_code)
+            SELECT DISTINCT ON (lower(r.first_name), lower(r.last_name), g.id)
+                   r.first_name, r.last_name, g.id, r.invite_code
+            FROM roster_import r
+            JOIN groups g ON g.name = r.group_name
+            WHERE NOT EXISTS (
+                SELECT 1 FROM students s
+                WHERE s.group_id = g.id
+                  AND lower(s.first_name) = lower(r.first_name)
+                  AND lower(s.last_name) = lower(r.last_name)
+            )
+            ORDER BY lower(r.first_name), lower(r.last_name), g.id
+            RETURNING last_name, first_name, invite_code, group_id
+        """)
+        imported = cursor.fetchall()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        release_connection(conn)
+    return imported, []
+
+@track_latency()
+async def handle_roster_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    if message.text and message.text.strip() == 'Назад':
+        await message.reply_text('Импорт отменён.', reply_markup=get_user_menu(message.from_user.id))
+        return ConversationHandler.END
+    if not message.document:
+        await message.reply_text('Отправьте список студентов CSV-файлом или нажмите "Назад".')
+        return IMPORT_ROSTER
+    if message.document.file_size and message.document.file_size > BULK_FILE_MAX_SIZE:
+        await message.reply_text('Файл слишком большой.')
+        return IMPORT_ROSTER
+
+    roster, errors = parse_roster(await download_text_document(message.document))
+    if errors:
+        shown = '\n'.join(errors[:20])
+        more = f'\n... и ещё {len(errors) - 20}' if len(errors) > 20 else ''
+        await message.reply_text(f'Список не принят, исправьте ошибки:\n{shown}{more}')
+        return IMPORT_ROSTER
+    if not roster:
+        await message.reply_text('Список пуст.')
+        return IMPORT_ROSTER
+
+    try:
+        imported, unknown_groups = import_roster(roster)
+    except Exception as e:
+        logger.error(f"Ошибка в handle_roster_upload: {e}", exc_info=True)
+        await message.reply_text('Произошла ошибка при импорте студентов.')
+        return ConversationHandler.END
+    if unknown_groups:
+        await message.reply_text('Группы не найдены: ' + ', '.join(unknown_groups))
+        return IMPORT_ROSTER
+
+    if imported:
+        bot_username = context.bot.username
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter=';')
+        writer.writerow(['Фамилия', 'Имя', 'Код', 'Ссылка'])
+        for last_name, first_name, invite_code, _ in imported:
+            writer.writerow([last_name, first_name, invite_code, f'https://t.me/{bot_username}?start={invite_code}'])
+        document = io.BytesIO(buffer.getvalue().encode('utf-8-sig'))
+        document.name = 'invites.csv'
+        await message.reply_document(document=document, caption='Ссылки-приглашения для студентов.')
+    await message.reply_text(
+        f'Импортировано студентов: {len(imported)}\nПропущено (уже есть в группе): {len(roster) - len(imported)}',
+        reply_markup=get_user_menu(message.from_user.id)
+    )
+    return ConversationHandler.END
+
+TIMETABLE_DAY_NAMES = dict(zip(WEEKDAYS, ('понедельник', 'вторник', 'среда', 'четверг', 'пятница', 'суббота', 'воскресенье')))
+TIMETABLE_DAYS = {
+    **{russian: english for english, russian in TIMETABLE_DAY_NAMES.items()},
+    **{day.lower(): day for day in WEEKDAYS},
+}
+TIMETABLE_WEEKS = {
+    'все': 'all', 'каждая': 'all', 'чёт': 'only_even', 'чет': 'only_even', 'чётная': 'only_even',
+    'четная': 'only_even', 'нечёт': 'only_odd', 'нечет': 'only_odd', 'нечётная': 'only_odd',
+    'нечетная': 'only_odd', 'all': 'all', 'only_even': 'only_even', 'only_odd': 'only_odd',
+}
+TIMETABLE_CLASS_TYPES = {
+    **{name.lower(): class_type for class_type, name in CLASS_TYPE_NAMES.items()},
+    'лаб': 'lab', 'лабораторная': 'lab', 'lecture': 'lecture', 'practice': 'practice', 'lab': 'lab',
+}
+TIMETABLE_HEADER = ['Группа', 'День', 'Неделя', 'Начало', 'Конец', 'Предмет', 'Тип']
+
+@is_admin()
+@track_latency()
+async def import_timetable_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT g.name, s.day_of_week, s.week_type, s.start_time, s.end_time, sub.name, s.class_type
+            FROM schedules s
+            JOIN groups g ON g.id = s.group_id
+            JOIN subjects sub ON sub.id = s.subject_id
+            ORDER BY g.name, array_position(%s, s.day_of_week::text), s.start_time
+        """, (list(WEEKDAYS),))
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+        release_connection(conn)
+
+    # The current timetable doubles as a template, so admins edit it instead of typing it from scratch
+    week_names = {'all': 'все', 'only_even': 'чёт', 'only_odd': 'нечёт'}
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=';')
+    writer.writerow(TIMETABLE_HEADER)
+    for group_name, day_of_week, week_type, start_time, end_time, subject_name, class_type in rows:
+        writer.writerow([
+            group_name, TIMETABLE_DAY_NAMES.get(day_of_week, day_of_week), week_names.get(week_type, week_type),
+            f'{start_time:%H:%M}', f'{end_time:%H:%M}', subject_name, CLASS_TYPE_NAMES.get(class_type, class_type)
+        ])
+    document = io.BytesIO(buffer.getvalue().encode('utf-8-sig'))
+    document.name = 'timetable.csv'
+    await update.message.reply_document(document=document, caption='Текущее расписание.')
+    await update.message.reply_text(
+        'Отправьте CSV-файл с расписанием: группа, день, неделя (все/чёт/нечёт), начало, конец, предмет, тип. '
+        'Расписание каждой группы из файла заменяется целиком, остальные группы не меняются. '
+        'Новые предметы создаются автоматически.',
+        reply_markup=ReplyKeyboardMarkup([[KeyboardButton('Назад')]], resize_keyboard=True)
+    )
+    return IMPORT_TIMETABLE
+
+def parse_timetable(text):
+    rows = read_csv_rows(text)
+    if rows and rows[0] and rows[0][0].strip().lower() == 'группа':
+        rows = rows[1:]
+    timetable = []
+    errors = []
+    seen = set()
+    for line_no, row in enumerate(rows, start=1):
+        cells = [' '.join(cell.split()) for cell in row]
+        if len(cells) < 7 or not all(cells[:7]):
+            errors.append(f'Строка {line_no}: нужны группа, день, неделя, начало, конец, предмет и тип')
+            continue
+        group_name, day, week, start, end, subject_name, class_type = cells[:7]
+        day_of_week = TIMETABLE_DAYS.get(day.lower())
+        week_type = TIMETABLE_WEEKS.get(week.lower())
+        class_type = TIMETABLE_CLASS_TYPES.get(class_type.lower())
+        try:
+            start_time = datetime.strptime(start, '%H:%M').time()
+            end_time = datetime.strptime(end, '%H:%M').time()
+        except ValueError:
+            start_time = end_time = None
+        if day_of_week is None:
+            errors.append(f'Строка {line_no}: неизвестный день "{day}"')
+        elif week_type is None:
+            errors.append(f'Строка {line_no}: неделя должна быть "все", "чёт" или "нечёт"')
+        elif class_type is None:
+            errors.append(f'Строка {line_no}: тип должен быть "лекция", "практика" или "лабораторная"')
+        elif start_time is None or start_time >= end_time:
+            errors.append(f'Строка {line_no}: время должно быть в формате ЧЧ:ММ, начало раньше конца')
+        elif (group_name, day_of_week, week_type, start_time) in seen:
+            errors.append(f'Строка {line_no}: у группы {group_name} уже есть занятие в это время')
+        else:
+            seen.add((group_name, day_of_week, week_type, start_time))
+            timetable.append((group_name, day_of_week, week_type, start_time, end_time, subject_name, class_type))
+    return timetable, errors
+
+# An entry is identified by (group, day, week type, start time): missing ones are removed, new ones
+# added, others updated if the subject, end time or type differ. The whole diff is applied by one
+# statement, so readers see either the old timetable or the new one.
+def import_timetable(timetable):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(timetable)
+    buffer.seek(0)
+
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TEMP TABLE timetable_import (
+                group_name VARCHAR(50),
+                day_of_week VARCHAR(10),
+                week_type VARCHAR(10),
+                start_time TIME,
+                end_time TIME,
+                subject_name VARCHAR(100),
+                class_type VARCHAR(20)
+            ) ON COMMIT DROP
+        """)
+        cursor.copy_expert("COPY timetable_import FROM STDIN WITH (FORMAT csv)", buffer)
+        cursor.execute("""
+            SELECT DISTINCT t.group_name FROM timetable_import t
+            LEFT JOIN groups g ON g.name = t.group_name
+            WHERE g.id IS NULL
+        """)
+        unknown_groups = [row[0] for row in cursor.fetchall()]
+        if unknown_groups:
+            conn.rollback()
+            return None, unknown_groups
+        cursor.execute("LOCK TABLE schedules IN SHARE ROW EXCLUSIVE MODE")
+        cursor.execute("""
+            INSERT INTO subjects (name)
+            SELECT DISTINCT subject_name FROM timetable_import
+            ON CONFLICT (name) DO NOTHING
+        """)
+        cursor.execute("""
+            WITH staged AS (
+                SELECT g.id AS group_id, t.day_of_week, t.week_type, sub.id AS subject_id,
+                       t.start_time, t.end_time, t.class_type
+                FROM timetable_import t
+                JOIN groups g ON g.name = t.group_name
+                JOIN subjects sub ON sub.name = t.subject_name
+            ),
+            removed AS (
+                DELETE FROM schedules s
+                WHERE s.group_id IN (SELECT group_id FROM staged)
+                  AND NOT EXISTS (
+                      SELECT 1 FROM staged t
+                      WHERE t.group_id = s.group_id AND t.day_of_week = s.day_of_week
+                        AND t.week_type = s.week_type AND t.start_time = s.start_time
+                  )
+                RETURNING s.group_id, 'removed' AS change
+            ),
+            changed AS (
+                UPDATE schedules s
+                SET subject_id = t.subject_id, end_time = t.end_time, class_type = t.class_type
+                FROM staged t
+                WHERE t.group_id = s.group_id AND t.day_of_week = s.day_of_week
+                  AND t.week_type = s.week_type AND t.start_time = s.start_time
+                  AND (s.subject_id, s.end_time, s.class_type) IS DISTINCT FROM (t.subject_id, t.end_time, t.class_type)
+                RETURNING s.group_id, 'changed' AS change
+            ),
+            added AS (
+                INSERT INTO schedules (group_id, day_of_week, week_type, subject_id, start_time, end_time, class_type)
+                SELECT t.group_id, t.day_of_week, t.week_type, t.subject_id, t.start_time, t.end_time, t.class_type
+                FROM staged t
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM schedules s
+                    WHERE s.group_id = t.group_id AND s.day_of_week = t.day_of_week
+                      AND s.week_type = t.week_type AND s.start_time = t.start_time
+                )
+                RETURNING group_id, 'added' AS change
+            ),
+            changes AS (
+                SELECT * FROM removed UNION ALL SELECT * FROM changed UNION ALL SELECT * FROM added
+            )
+            SELECT c.group_id, g.name, c.change, count(*)
+            FROM changes c
+            JOIN groups g ON g.id = c.group_id
+            GROUP BY c.group_id, g.name, c.change
+            ORDER BY g.name
+        """)
+        diff = cursor.fetchall()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        release_connection(conn)
+    return diff, []
+
+async def replan_group_notifications(application, group_ids):
+    # Drop today's pending reminders and attendance collections of these groups, then plan them again
+    for job in scheduler.get_jobs():
+        if job.func in (send_class_notification_job, collect_attendance_job, send_daily_digest_job) and job.args[1] in group_ids:
+            job.remove()
+    await schedule_daily_notifications(application, list(group_ids))
+
+@track_latency()
+async def handle_timetable_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    if message.text and message.text.strip() == 'Назад':
+        await message.reply_text('Импорт отменён.', reply_markup=get_user_menu(message.from_user.id))
+        return ConversationHandler.END
+    if not message.document:
+        await message.reply_text('Отправьте расписание CSV-файлом или нажмите "Назад".')
+        return IMPORT_TIMETABLE
+    if message.document.file_size and message.document.file_size > BULK_FILE_MAX_SIZE:
+        await message.reply_text('Файл слишком большой.')
+        return IMPORT_TIMETABLE
+
+    timetable, errors = parse_timetable(await download_text_document(message.document))
+    if errors:
+        shown = '\n'.join(errors[:20])
+        more = f'\n... и ещё {len(errors) - 20}' if len(errors) > 20 else ''
+        await message.reply_text(f'Расписание не принято, исправьте ошибки:\n{shown}{more}')
+        return IMPORT_TIMETABLE
+    if not timetable:
+        await message.reply_text('Расписание пусто.')
+        return IMPORT_TIMETABLE
+
+    try:
+        diff, unknown_groups = import_timetable(timetable)
     except Exception as e:
-        logger.error(f"Ошибка в clean_users: {e}", exc_info=True)
-        await update.message.reply_text('Произошла ошибка при удалении пользователей.')
+        logger.error(f"Ошибка в handle_timetable_upload: {e}", exc_info=True)
+        await message.reply_text('Произошла ошибка при импорте расписания.')
+        return ConversationHandler.END
+    if unknown_groups:
+        await message.reply_text('Группы не найдены: ' + ', '.join(unknown_groups))
+        return IMPORT_TIMETABLE
+
+    changed_groups = {group_id for group_id, _, _, _ in diff}
+    if changed_groups:
+        invalidate_group_timetables(changed_groups)
+        try:
+            await replan_group_notifications(context.application, changed_groups)
+        except Exception as e:
+            logger.error(f"Ошибка при перепланировании уведомлений: {e}", exc_info=True)
+
+    summary = {}
+    for _, group_name, change, count in diff:
+        summary.setdefault(group_name, {})[change] = count
+    lines = [
+        f"{group_name}: +{changes.get('added', 0)} / -{changes.get('removed', 0)} / ~{changes.get('changed', 0)}"
+        for group_name, changes in summary.items()
+    ]
+    unchanged = len({row[0] for row in timetable}) - len(summary)
+    text = 'Расписание обновлено (добавлено / удалено / изменено):\n' + '\n'.join(lines) if lines else 'Изменений нет.'
+    if unchanged and lines:
+        text += f'\nБез изменений групп: {unchanged}'
+    await message.reply_text(text, reply_markup=get_user_menu(message.from_user.id))
+    return ConversationHandler.END
+
+# Heavy serialization and compression run in worker processes so the event loop keeps
+# serving chats. Jobs get plain picklable arguments and a deadline they check themselves,
+# since a job already running in a worker can't be cancelled from outside.
+render_pool = None
+RENDER_PROGRESS_DELAY = 2
+
+class RenderTimeout(Exception):
+    pass
+
+def check_deadline(deadline):
+    if deadline is not None and time.time() > deadline:
+        raise RenderTimeout()
+
+def start_render_pool():
+    global render_pool
+    if RENDER_WORKERS > 0:
+        render_pool = ProcessPoolExecutor(RENDER_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+
+async def run_render_job(func, *args, message=None, timeout=RENDER_TIMEOUT):
+    deadline = time.time() + timeout
+    if render_pool is None:
+        future = asyncio.ensure_future(asyncio.to_thread(func, *args, deadline))
+    else:
+        future = asyncio.wrap_future(render_pool.submit(func, *args, deadline))
+    progress = None
+    try:
+        if message is not None:
+            done, _ = await asyncio.wait({future}, timeout=RENDER_PROGRESS_DELAY)
+            if not done:
+                progress = await message.reply_text('Файл готовится, это может занять некоторое время...')
+        return await asyncio.wait_for(future, timeout=max(deadline - time.time(), 0))
+    except asyncio.TimeoutError:
+        raise RenderTimeout()
+    finally:
+        if progress is not None:
+            try:
+                await progress.delete()
+            except Exception:
+                pass
+
+# The worker reads the table itself through a server-side cursor, so rows are neither held
+# in the bot process nor pickled across to the worker
+def render_table_export(path, connection_params, table_name, file_format, deadline):
+    conn = psycopg2.connect(**connection_params)
+    conn.set_session(readonly=True)
+    count = 0
+    try:
+        cursor = conn.cursor(name='table_export')
+        cursor.itersize = REPORT_FETCH_SIZE
+        cursor.execute(f"SELECT * FROM {table_name}")
+        rows = iter(cursor)
+        first = next(rows, None)
+        columns = [column[0] for column in cursor.description]
+        rows = itertools.chain([first], rows) if first is not None else ()
+        with open(path, 'w', newline='', encoding='utf-8') as file:
+            if file_format == 'CSV':
+                writer = csv.writer(file)
+                writer.writerow(columns)
+                for row in rows:
+                    if count % 1000 == 0:
+                        check_deadline(deadline)
+                    writer.writerow(row)
+                    count += 1
+            else:
+                file.write('[')
+                for row in rows:
+                    if count % 1000 == 0:
+                        check_deadline(deadline)
+                    record = json.dumps(dict(zip(columns, row)), ensure_ascii=False, indent=4, default=str)
+                    file.write((',\n    ' if count else '\n    ') + record.replace('\n', '\n    '))
+                    count += 1
+                file.write('\n]' if count else ']')
+        cursor.close()
     finally:
+        conn.close()
+    return count
+
+def compress_file(path, deadline):
+    # mtime=0 keeps the archive identical for identical input, so sent_files can match it
+    compressed = path + '.gz'
+    with open(path, 'rb') as source, gzip.GzipFile(compressed, 'wb', mtime=0) as target:
+        for chunk in iter(lambda: source.read(1 << 20), b''):
+            check_deadline(deadline)
+            target.write(chunk)
+    return compressed
+
+def file_digest(path):
+    digest = hashlib.sha256(os.path.basename(path).encode('utf-8'))
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def lookup_sent_file(content_hash):
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT file_id FROM sent_files WHERE content_hash = %s", (content_hash,))
+        row = cursor.fetchone()
+        cursor.close()
+        return row[0] if row else None
+    finally:
+        release_connection(conn)
+
+def store_sent_file(content_hash, file_id):
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO sent_files (content_hash, file_id) VALUES (%s, %s)
+            ON CONFLICT (content_hash) DO UPDATE SET file_id = EXCLUDED.file_id, sent_at = now()
+        """, (content_hash, file_id))
+        conn.commit()
         cursor.close()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
         release_connection(conn)
 
+# Files already uploaded once are resent by file_id, Telegram keeps them on its side
+async def send_cached_document(bot, chat_id, path, caption):
+    content_hash = file_digest(path)
+    token = db_route.set(None)
+    try:
+        file_id = lookup_sent_file(content_hash)
+        if file_id:
+            try:
+                return await bot.send_document(chat_id=chat_id, document=file_id, caption=caption)
+            except BadRequest as e:
+                logger.warning(f"Сохранённый file_id больше не действителен, файл будет загружен заново: {e}")
+        with open(path, 'rb') as file:
+            message = await bot.send_document(chat_id=chat_id, document=file, caption=caption)
+        store_sent_file(content_hash, message.document.file_id)
+        return message
+    finally:
+        db_route.reset(token)
+
 @is_admin()
+@track_latency()
 async def backup_database(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text('Создаю резервную копию базы данных...')
 
     await perform_backup_and_send(context.application, update.effective_chat.id)
 
-async def perform_backup_and_send(application, chat_id):
+# The dump is made once per call and shared by all recipients
+async def perform_backup_and_send(application, *chat_ids):
     pg_dump_path = "pg_dump"
     db_name = os.getenv("DB_NAME")
     db_user = os.getenv("DB_USER")
     db_host = os.getenv("DB_HOST", "127.0.0.1")
     db_port = os.getenv("DB_PORT")
     backup_file = "backup.sql"
+    compressed_file = None
 
     try:
         command = [
@@ -1201,31 +3886,33 @@ async def perform_backup_and_send(application, chat_id):
         env["PGPASSWORD"] = os.getenv("DB_PASSWORD")
 
         with open(backup_file, 'w', encoding='utf-8') as outfile:
-            subprocess.run(command, env=env, check=True, stdout=outfile, stderr=subprocess.STDOUT, text=True)
+            await asyncio.to_thread(subprocess.run, command, env=env, check=True, stdout=outfile,
+                                    stderr=subprocess.STDOUT, text=True)
+        compressed_file = await run_render_job(compress_file, backup_file)
 
-        try:
-            with open(backup_file, "rb") as file:
-                await application.bot.send_document(
-                    chat_id=chat_id,
-                    document=file,
-                    caption="Резервная копия базы данных."
-                )
+        for chat_id in chat_ids:
+            try:
+                await send_cached_document(application.bot, chat_id, compressed_file, "Резервная копия базы данных.")
                 logger.warning(f'Резервная копия успешно создана и отправлена администратору {chat_id}.')
-        except Exception as e:
-            logger.error(f"Ошибка при отправке файла: {e}", exc_info=True)
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Ошибка резервного копирования: {e}", exc_info=True)
+            except Exception as e:
+                logger.error(f"Ошибка при отправке файла: {e}", exc_info=True)
+    except (subprocess.CalledProcessError, RenderTimeout) as e:
+        logger.error(f"Ошибка резервного копирования: {e!r}", exc_info=True)
     finally:
-        if os.path.exists(backup_file):
-            os.remove(backup_file)
+        for path in (backup_file, compressed_file):
+            if path and os.path.exists(path):
+                os.remove(path)
 
+@track_latency(scheduler_job_duration)
 async def automatic_backup_database(application):
     logger.warning("Запуск автоматического резервного копирования базы данных.")
-    for admin_id in ADMIN_IDS:
-        await perform_backup_and_send(application, admin_id)
+    await perform_backup_and_send(application, *ADMIN_IDS)
 
 @is_admin()
+@track_latency()
+@read_only()
 async def export_data_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global export_table_names
     conn = get_connection()
     try:
         cursor = conn.cursor()
@@ -1245,13 +3932,14 @@ async def export_data_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         release_connection(conn)
     
     if tables:
-        table_names = [table[0] for table in tables]
+        table_names = [ATTENDANCE_REPORT_BUTTON] + [table[0] for table in tables]
         table_names.append('Назад')
         keyboard = [KeyboardButton(name) for name in table_names]
         keyboard = [keyboard[i:i+2] for i in range(0, len(keyboard), 2)]
         reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
         await update.message.reply_text('Выберите таблицу для экспорта данных:', reply_markup=reply_markup)
-        context.user_data['available_tables'] = table_names
+        export_table_names = tuple(table[0] for table in tables)
+        flow_states.start(update.effective_user.id, ExportFlow())
         return EXPORT_SELECT_TABLE
     else:
         await update.message.reply_text('В базе данных нет доступных таблиц для экспорта.')
@@ -1262,8 +3950,13 @@ async def handle_table_selection(update: Update, context: ContextTypes.DEFAULT_T
     if selected_table == 'Назад':
         await update.message.reply_text('Операция экспорта отменена.', reply_markup=get_user_menu(update.message.from_user.id))
         return ConversationHandler.END
-    if selected_table in context.user_data.get('available_tables', []):
-        context.user_data['selected_table'] = selected_table
+    if selected_table == ATTENDANCE_REPORT_BUTTON:
+        return await attendance_report_start(update, context)
+    flow = flow_states.get(update.message.from_user.id, ExportFlow)
+    if flow is None:
+        return await flow_expired(update)
+    if selected_table in export_table_names:
+        flow.table = selected_table
         keyboard = [
             [KeyboardButton('CSV'), KeyboardButton('JSON')],
             [KeyboardButton('Назад')]
@@ -1275,61 +3968,501 @@ async def handle_table_selection(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text('Пожалуйста, выберите таблицу из списка или нажмите "Назад".')
         return EXPORT_SELECT_TABLE
 
+@track_latency()
 async def handle_format_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     selected_format = update.message.text.upper()
     if selected_format == 'НАЗАД':
         await export_data_start(update, context)
         return EXPORT_SELECT_TABLE
     if selected_format in ['CSV', 'JSON']:
-        table_name = context.user_data['selected_table']
-        await export_table_data(update, context, table_name, selected_format)
+        flow = flow_states.get(update.message.from_user.id, ExportFlow)
+        if flow is None or flow.table is None:
+            return await flow_expired(update)
+        flow_states.end(update.message.from_user.id, ExportFlow)
+        await export_table_data(update, context, flow.table, selected_format)
         return ConversationHandler.END
     else:
         await update.message.reply_text('Пожалуйста, выберите формат из списка: CSV или JSON, или нажмите "Назад".')
         return EXPORT_SELECT_FORMAT
 
+@read_only()
 async def export_table_data(update: Update, context: ContextTypes.DEFAULT_TYPE, table_name: str, file_format: str):
-    conn = get_connection()
+    if file_format not in ('CSV', 'JSON'):
+        await update.message.reply_text('Неподдерживаемый формат файла.')
+        return
+    file_name = f"{table_name}.{file_format.lower()}"
     try:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute(f"SELECT * FROM {table_name}")
-        records = cursor.fetchall()
-        if records:
-            if file_format == 'CSV':
-                import csv
-                file_name = f"{table_name}.csv"
-                with open(file_name, 'w', newline='', encoding='utf-8') as csvfile:
-                    writer = csv.DictWriter(csvfile, fieldnames=records[0].keys())
-                    writer.writeheader()
-                    writer.writerows(records)
-            elif file_format == 'JSON':
-                import json
-                file_name = f"{table_name}.json"
-                with open(file_name, 'w', encoding='utf-8') as jsonfile:
-                    json.dump(records, jsonfile, ensure_ascii=False, indent=4)
-            else:
-                await update.message.reply_text('Неподдерживаемый формат файла.')
-                return
-            with open(file_name, 'rb') as file:
-                await context.bot.send_document(
-                    chat_id=update.effective_chat.id,
-                    document=file,
-                    caption=f'Экспортированные данные из таблицы {table_name} в формате {file_format}.'
-                )
-            os.remove(file_name)
-            await update.message.reply_text('Данные успешно экспортированы и отправлены.')
-        else:
+        count = await run_render_job(render_table_export, file_name, report_connection_params(), table_name, file_format,
+                                     message=update.message)
+        if not count:
             await update.message.reply_text(f'Таблица {table_name} не содержит данных.')
+            return
+        await send_cached_document(
+            context.bot,
+            update.effective_chat.id,
+            file_name,
+            f'Экспортированные данные из таблицы {table_name} в формате {file_format}.'
+        )
+        await update.message.reply_text('Данные успешно экспортированы и отправлены.')
+    except RenderTimeout:
+        await update.message.reply_text('Экспорт занял слишком много времени и был отменён.')
     except Exception as e:
         logger.error(f"Ошибка в export_table_data: {e}", exc_info=True)
         await update.message.reply_text('Произошла ошибка при экспорте данных.')
+    finally:
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
+# Autumn semester runs September to January, spring February to August
+def semester_of(day):
+    if day.month >= 9:
+        return day.year, 'осень'
+    if day.month == 1:
+        return day.year - 1, 'осень'
+    return day.year - 1, 'весна'
+
+def semester_label(semester):
+    year, season = semester
+    return f'{year}/{str(year + 1)[-2:]}, {season}'
+
+def semester_bounds(semester):
+    year, season = semester
+    if season == 'осень':
+        return datetime(year, 9, 1).date(), datetime(year + 1, 1, 31).date()
+    return datetime(year + 1, 2, 1).date(), datetime(year + 1, 8, 31).date()
+
+@track_latency()
+@read_only()
+async def attendance_report_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, name FROM groups ORDER BY name")
+        groups = cursor.fetchall()
     finally:
         cursor.close()
         release_connection(conn)
+    if not groups:
+        await update.message.reply_text('Список групп пуст.')
+        return ConversationHandler.END
+    flow_states.start(update.message.from_user.id, ReportFlow())
+    keyboard = [KeyboardButton(name) for _, name in groups] + [KeyboardButton('Назад')]
+    keyboard = [keyboard[i:i+3] for i in range(0, len(keyboard), 3)]
+    await update.message.reply_text(
+        'Выберите группу для отчёта посещаемости:',
+        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+    )
+    return EXPORT_REPORT_GROUP
+
+@track_latency()
+@read_only()
+async def handle_report_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip()
+    if text == 'Назад':
+        return await export_data_start(update, context)
+    flow = flow_states.get(update.message.from_user.id, ReportFlow)
+    if flow is None:
+        return await flow_expired(update)
+
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM groups WHERE name = %s", (text,))
+        group = cursor.fetchone()
+        if group is None:
+            await update.message.reply_text('Пожалуйста, выберите группу из списка или нажмите "Назад".')
+            return EXPORT_REPORT_GROUP
+        group_id = group[0]
+        cursor.execute("""
+            SELECT DISTINCT date_trunc('month', aj.date)::date
+            FROM attendance_journal aj
+            JOIN students s ON s.id = aj.student_id
+            WHERE s.group_id = %s
+        """, (group_id,))
+        months = [row[0] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+        release_connection(conn)
+    if not months:
+        await update.message.reply_text('По этой группе нет записей посещаемости.')
+        return EXPORT_REPORT_GROUP
+
+    semesters = sorted({semester_of(month) for month in months}, reverse=True)
+    flow.group_id, flow.group_name, flow.semesters = group_id, text, tuple(semesters)
+    keyboard = [[KeyboardButton(semester_label(semester))] for semester in semesters] + [[KeyboardButton('Назад')]]
+    await update.message.reply_text(
+        'Выберите семестр:',
+        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+    )
+    return EXPORT_REPORT_SEMESTER
+
+async def handle_report_semester(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip()
+    if text == 'Назад':
+        return await attendance_report_start(update, context)
+    flow = flow_states.get(update.message.from_user.id, ReportFlow)
+    if flow is None or flow.semesters is None:
+        return await flow_expired(update)
+    semester = next((semester for semester in flow.semesters if semester_label(semester) == text), None)
+    if semester is None:
+        await update.message.reply_text('Пожалуйста, выберите семестр из списка или нажмите "Назад".')
+        return EXPORT_REPORT_SEMESTER
+    flow.semester = semester
+    formats = [KeyboardButton('XLSX')] + ([KeyboardButton('Parquet')] if pyarrow else [])
+    await update.message.reply_text(
+        'Выберите формат отчёта:',
+        reply_markup=ReplyKeyboardMarkup([formats, [KeyboardButton('Назад')]], resize_keyboard=True, one_time_keyboard=True)
+    )
+    return EXPORT_REPORT_FORMAT
+
+# Columns are the (date, subject) pairs of the semester, one row per student of the group
+def report_columns(cursor, group_id, start, end):
+    cursor.execute("""
+        SELECT DISTINCT aj.date, aj.subject_id, subj.name
+        FROM attendance_journal aj
+        JOIN students s ON s.id = aj.student_id
+        JOIN subjects subj ON subj.id = aj.subject_id
+        WHERE s.group_id = %s AND aj.date BETWEEN %s AND %s
+        ORDER BY aj.date, subj.name
+    """, (group_id, start, end))
+    return cursor.fetchall()
+
+# Rows come from a server-side cursor ordered by student, so only one student is held at a time
+def report_rows(conn, group_id, start, end, columns, deadline=None):
+    positions = {(day, subject_id): i for i, (day, subject_id, _) in enumerate(columns)}
+    cursor = conn.cursor(name='attendance_report')
+    cursor.itersize = REPORT_FETCH_SIZE
+    try:
+        cursor.execute("""
+            SELECT s.id, s.last_name, s.first_name, aj.date, aj.subject_id, aj.status
+            FROM students s
+            LEFT JOIN attendance_journal aj ON aj.student_id = s.id AND aj.date BETWEEN %s AND %s
+            WHERE s.group_id = %s
+            ORDER BY s.last_name, s.first_name, s.id
+        """, (start, end, group_id))
+        for _, records in itertools.groupby(cursor, key=lambda record: record[0]):
+            check_deadline(deadline)
+            records = list(records)
+            cells = [''] * len(columns)
+            absences = 0
+            for _, _, _, day, subject_id, status in records:
+                if day is None:
+                    continue
+                cells[positions[(day, subject_id)]] = 'н' if status == 'absent' else '+'
+                absences += status == 'absent'
+            yield f'{records[0][1]} {records[0][2]}', cells, absences
+    finally:
+        cursor.close()
+
+def report_header(columns):
+    return ['Студент'] + [f'{day:%d.%m.%Y} {name}' for day, _, name in columns] + ['Пропусков']
+
+def xlsx_column(index):
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+def xlsx_escape(value):
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def xlsx_row(number, values):
+    cells = []
+    for i, value in enumerate(values):
+        ref = f'{xlsx_column(i)}{number}'
+        if isinstance(value, int):
+            cells.append(f'<c r="{ref}"><v>{value}</v></c>')
+        elif value:
+            cells.append(f'<c r="{ref}" t="inlineStr"><is><t>{xlsx_escape(value)}</t></is></c>')
+    return f'<row r="{number}">{"".join(cells)}</row>'
+
+XLSX_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Посещаемость" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+# Minimal SpreadsheetML package; the sheet is streamed into the zip row by row
+def write_report_xlsx(path, columns, rows):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, content in XLSX_PARTS.items():
+            archive.writestr(name, content)
+        with archive.open('xl/worksheets/sheet1.xml', 'w') as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                b'<sheetViews><sheetView workbookViewId="0"><pane xSplit="1" ySplit="1" topLeftCell="B2" state="frozen"/></sheetView></sheetViews>'
+                b'<sheetData>'
+            )
+            sheet.write(xlsx_row(1, report_header(columns)).encode('utf-8'))
+            for number, (student, cells, absences) in enumerate(rows, start=2):
+                sheet.write(xlsx_row(number, [student] + cells + [absences]).encode('utf-8'))
+            sheet.write(b'</sheetData></worksheet>')
+
+def write_report_parquet(path, columns, rows):
+    header = report_header(columns)
+    schema = pyarrow.schema(
+        [(header[0], pyarrow.string())]
+        + [(name, pyarrow.string()) for name in header[1:-1]]
+        + [(header[-1], pyarrow.int32())]
+    )
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for batch in iter(lambda: list(itertools.islice(rows, REPORT_FETCH_SIZE)), []):
+            arrays = [[student for student, _, _ in batch]]
+            arrays += [[cells[i] or None for _, cells, _ in batch] for i in range(len(columns))]
+            arrays.append([absences for _, _, absences in batch])
+            writer.write_batch(pyarrow.record_batch(arrays, schema=schema))
+
+REPORT_WRITERS = {'XLSX': write_report_xlsx, 'PARQUET': write_report_parquet}
+
+# Runs in a render worker with its own connection, the pool belongs to the bot process
+def build_attendance_report(path, connection_params, group_id, semester, file_format, deadline):
+    start, end = semester_bounds(semester)
+    conn = psycopg2.connect(**connection_params)
+    # Columns and rows are read from one snapshot, so every attendance row has its column
+    conn.set_session(readonly=True, isolation_level='REPEATABLE READ')
+    try:
+        cursor = conn.cursor()
+        columns = report_columns(cursor, group_id, start, end)
+        cursor.close()
+        REPORT_WRITERS[file_format](path, columns, report_rows(conn, group_id, start, end, columns, deadline))
+    finally:
+        conn.close()
+
+def report_connection_params():
+    if db_route.get() == 'replica':
+        healthy = [replica for replica in replicas if replica.healthy]
+        if healthy:
+            return {'dsn': random.choice(healthy).dsn}
+    return DB_PARAMS
+
+@track_latency()
+@read_only()
+async def handle_report_format(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip().upper()
+    if text == 'НАЗАД':
+        return await attendance_report_start(update, context)
+    if text not in REPORT_WRITERS or (text == 'PARQUET' and not pyarrow):
+        await update.message.reply_text('Пожалуйста, выберите формат из списка или нажмите "Назад".')
+        return EXPORT_REPORT_FORMAT
+
+    flow = flow_states.get(update.message.from_user.id, ReportFlow)
+    if flow is None or flow.semester is None:
+        return await flow_expired(update)
+    flow_states.end(update.message.from_user.id, ReportFlow)
+    group_id, group_name, semester = flow.group_id, flow.group_name, flow.semester
+    year, season = semester
+    safe_name = re.sub(r'[^\w-]+', '_', group_name)
+    file_name = f"attendance_{safe_name}_{year}_{'autumn' if season == 'осень' else 'spring'}.{text.lower()}"
+    try:
+        await run_render_job(build_attendance_report, file_name, report_connection_params(), group_id, semester, text,
+                             message=update.message)
+        await send_cached_document(
+            context.bot,
+            update.effective_chat.id,
+            file_name,
+            f'Посещаемость группы {group_name}, {semester_label(semester)}.'
+        )
+        await update.message.reply_text('Отчёт отправлен.', reply_markup=get_user_menu(update.message.from_user.id))
+    except RenderTimeout:
+        await update.message.reply_text('Отчёт формировался слишком долго и был отменён.',
+                                        reply_markup=get_user_menu(update.message.from_user.id))
+    except Exception as e:
+        logger.error(f"Ошибка в handle_report_format: {e}", exc_info=True)
+        await update.message.reply_text('Произошла ошибка при формировании отчёта.',
+                                        reply_markup=get_user_menu(update.message.from_user.id))
+    finally:
+        if os.path.exists(file_name):
+            os.remove(file_name)
+    return ConversationHandler.END
+
+ATTENDANCE_CALLBACK_PREFIXES = ('present_', 'absent_', 'digest_', 'checkin_', 'edit_', 'change_', 'confirm_')
+VIEW_REQUESTS = ('📅 Расписание', 'Сегодня', 'Завтра', 'На неделю', '📝 Аттестация')
+PRIORITY_ATTENDANCE, PRIORITY_DEFAULT, PRIORITY_VIEW = range(3)
+
+intake_dropped = Counter('bot_intake_dropped_total', 'Updates dropped before reaching handlers.', 'reason')
+
+def update_priority(update):
+    if update.callback_query and (update.callback_query.data or '').startswith(ATTENDANCE_CALLBACK_PREFIXES):
+        return PRIORITY_ATTENDANCE
+    # A whole lecture checks in within a minute, so codes from students of an open session are never shed
+    user = update.effective_user
+    if update.message and update.message.text and user and user.id in checkin_participants and (
+        CHECKIN_CODE.fullmatch(update.message.text.strip())
+        or update.message.text.startswith(f'/start {CHECKIN_LINK_PREFIX}')
+    ):
+        return PRIORITY_ATTENDANCE
+    if update.message and update.message.text in VIEW_REQUESTS:
+        return PRIORITY_VIEW
+    return PRIORITY_DEFAULT
+
+def coalesce_key(update):
+    user_id = update.effective_user.id
+    if update.callback_query:
+        return user_id, update.callback_query.data
+    if update.message and update.message.text in VIEW_REQUESTS:
+        return user_id, update.message.text
+    return None
+
+# Admission control in front of the handlers: per-user token buckets, coalescing of
+# identical requests already queued or running, and priority scheduling over a fixed
+# number of slots. Views are shed first when the DB pool or the queue fills up,
+# attendance callbacks never. Updates of one user still run one at a time, which
+# keeps ConversationHandler state consistent.
+class IntakeGuard(BaseUpdateProcessor):
+    def __init__(self, concurrency, queue_limit, rate, burst):
+        # The base semaphore only bounds tasks; admission is decided below
+        super().__init__(max_concurrent_updates=concurrency + queue_limit + 1024)
+        self.concurrency = concurrency
+        self.queue_limit = queue_limit
+        self.rate = rate
+        self.burst = burst
+        self.running = 0
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.buckets = {}
+        self.in_flight = set()
+        self.user_locks = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def take_token(self, user_id):
+        now = time.monotonic()
+        tokens, updated, warned = self.buckets.get(user_id, (self.burst, now, 0.0))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        # Warn a flooding user at most once per refill period
+        notify = not allowed and now - warned > self.burst / self.rate
+        self.buckets[user_id] = (tokens, now, now if notify else warned)
+        if len(self.buckets) > 10000:
+            self.buckets = {
+                uid: bucket for uid, bucket in self.buckets.items()
+                if bucket[0] + (now - bucket[1]) * self.rate < self.burst
+            }
+        return allowed, notify
+
+    def saturated(self, priority):
+        if priority == PRIORITY_ATTENDANCE:
+            return False
+        pool_busy = len(connection_pool._used) >= connection_pool.maxconn * 0.8
+        if priority == PRIORITY_VIEW:
+            return pool_busy or len(self.waiting) >= self.queue_limit // 2
+        return len(self.waiting) >= self.queue_limit
+
+    async def acquire_slot(self, priority):
+        if self.running < self.concurrency and not self.waiting:
+            self.running += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self.sequence), future)
+        heapq.heappush(self.waiting, entry)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release_slot()
+            else:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+            raise
+
+    def release_slot(self):
+        while self.waiting:
+            _, _, future = heapq.heappop(self.waiting)
+            if not future.done():
+                # Hand the slot over directly, running stays the same
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    async def reject(self, update, reason, text):
+        intake_dropped.inc(reason)
+        try:
+            if update.callback_query:
+                await update.callback_query.answer(text)
+            elif update.effective_message and text:
+                await update.effective_message.reply_text(text)
+        except Exception as e:
+            logger.error(f"Ошибка при отклонении обновления: {e}", exc_info=True)
+
+    async def do_process_update(self, update, coroutine):
+        if not isinstance(update, Update) or update.effective_user is None:
+            await coroutine
+            return
+        user_id = update.effective_user.id
+        priority = update_priority(update)
+
+        # Inline queries come per keystroke and are answered from memory, they don't spend tokens
+        allowed, notify = self.take_token(user_id) if update.inline_query is None else (True, False)
+        if not allowed:
+            coroutine.close()
+            await self.reject(update, 'flood', 'Слишком много запросов, подождите немного.' if notify else None)
+            return
+        key = coalesce_key(update)
+        if key is not None and key in self.in_flight:
+            coroutine.close()
+            await self.reject(update, 'duplicate', None)
+            return
+        if self.saturated(priority):
+            coroutine.close()
+            await self.reject(update, 'shed', 'Бот сейчас перегружен, попробуйте через минуту.')
+            return
+
+        if key is not None:
+            self.in_flight.add(key)
+        lock = self.user_locks.setdefault(user_id, [asyncio.Lock(), 0])
+        lock[1] += 1
+        try:
+            async with lock[0]:
+                await self.acquire_slot(priority)
+                try:
+                    await coroutine
+                finally:
+                    self.release_slot()
+        finally:
+            self.in_flight.discard(key)
+            lock[1] -= 1
+            if not lock[1]:
+                del self.user_locks[user_id]
 
 def schedule_jobs(application):
     global scheduler
     scheduler = AsyncIOScheduler(timezone="Europe/Moscow")
+    scheduler.add_listener(observe_job_submitted, EVENT_JOB_SUBMITTED)
+    scheduler.add_listener(observe_job_missed, EVENT_JOB_MISSED)
     scheduler.start()
 
     scheduler.add_job(
@@ -1351,7 +4484,15 @@ def schedule_jobs(application):
     )
 
 def main():
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+    intake_guard = IntakeGuard(INTAKE_CONCURRENCY, INTAKE_QUEUE_LIMIT, INTAKE_RATE, INTAKE_BURST)
+    Gauge('bot_intake_running', 'Updates being handled.', lambda: intake_guard.running)
+    Gauge('bot_intake_waiting', 'Updates waiting for a handler slot.', lambda: len(intake_guard.waiting))
+    builder = ApplicationBuilder().token(BOT_TOKEN).request(RoutedRequest()).concurrent_updates(intake_guard)
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(BOT_API_BASE_URL)
+    application = builder.build()
+
+    application.add_handler(TypeHandler(Update, assign_correlation_id), group=-1)
 
     registration_conv_handler = ConversationHandler(
         entry_points=[CommandHandler('start', start)],
@@ -1369,6 +4510,7 @@ def main():
         states={
             SELECT_STUDENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, select_student)],
             ENTER_GRADE: [MessageHandler(filters.TEXT & ~filters.COMMAND, enter_grade)],
+            BULK_GRADES: [MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.Document.ALL, handle_bulk_grades)],
         },
         fallbacks=[CommandHandler('cancel', cancel)]
     )
@@ -1379,11 +4521,43 @@ def main():
         states={
             EXPORT_SELECT_TABLE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_table_selection)],
             EXPORT_SELECT_FORMAT: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_format_selection)],
+            EXPORT_REPORT_GROUP: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_report_group)],
+            EXPORT_REPORT_SEMESTER: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_report_semester)],
+            EXPORT_REPORT_FORMAT: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_report_format)],
         },
         fallbacks=[CommandHandler('cancel', cancel)]
     )
     application.add_handler(export_data_conv_handler)
 
+    import_roster_conv_handler = ConversationHandler(
+        entry_points=[MessageHandler(filters.Regex('^📥 Импорт студентов$'), import_roster_start)],
+        states={
+            IMPORT_ROSTER: [MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.Document.ALL, handle_roster_upload)],
+        },
+        fallbacks=[CommandHandler('cancel', cancel)]
+    )
+    application.add_handler(import_roster_conv_handler)
+
+    import_timetable_conv_handler = ConversationHandler(
+        entry_points=[MessageHandler(filters.Regex('^🗓 Импорт расписания$'), import_timetable_start)],
+        states={
+            IMPORT_TIMETABLE: [MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.Document.ALL, handle_timetable_upload)],
+        },
+        fallbacks=[CommandHandler('cancel', cancel)]
+    )
+    application.add_handler(import_timetable_conv_handler)
+
+    purge_conv_handler = ConversationHandler(
+        entry_points=[MessageHandler(filters.Regex('^🗑 Удалить пользователей$'), clean_users)],
+        states={
+            PURGE_SELECT_SCOPE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_purge_scope)],
+            PURGE_SELECT_TARGET: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_purge_target)],
+            PURGE_CONFIRM: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_purge_confirm)],
+        },
+        fallbacks=[CommandHandler('cancel', cancel)]
+    )
+    application.add_handler(purge_conv_handler)
+
     broadcast_conv_handler = ConversationHandler(
         entry_points=[MessageHandler(filters.Regex('^📢 Рассылка сообщения$'), broadcast_message)],
         states={
@@ -1412,9 +4586,16 @@ def main():
     application.add_handler(assign_deputy_conv_handler)
 
     application.add_handler(CallbackQueryHandler(button_callback))
+    application.add_handler(InlineQueryHandler(handle_inline_query))
 
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_menu))
 
+    start_metrics_server()
+    start_calendar_server()
+    start_slow_query_log()
+    start_replica_checks()
+    start_render_pool()
+    start_role_cache()
     schedule_jobs(application)
 
     application.run_polling()
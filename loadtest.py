@@ -0,0 +1,367 @@
+"""Нагрузочный тест бота: bot.py против поддельного Bot API и локальной PostgreSQL.
+
+Запуск (на отдельной, тестовой базе — скрипт создаёт и удаляет свои данные):
+
+    python loadtest.py --seed --students 200 --duration 60
+
+Скрипт поднимает поддельный сервер Bot API (getUpdates/вебхук, sendMessage,
+editMessageText, sendDocument и т.д.), запускает bot.py с BOT_API_BASE_URL,
+указывающим на него, и имитирует студентов, которые нажимают
+"Сегодня"/"На неделю", "📝 Аттестация" и кнопки посещаемости. В конце выводятся
+p50/p95/p99 задержки ответа и пропускная способность.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+import urllib.request
+from datetime import datetime
+from urllib.parse import parse_qs
+
+import psycopg2
+from psycopg2.extras import execute_values
+from dotenv import load_dotenv
+
+load_dotenv()
+
+LOADTEST_ID_BASE = 9_000_000_000
+LOADTEST_GROUP_PREFIX = 'LT-'
+LOADTEST_SUBJECT_PREFIX = 'LT Предмет '
+LOADTEST_TOKEN = '123456:LOADTEST'
+DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+CLASS_TIMES = [('09:00', '10:30'), ('10:40', '12:10'), ('12:40', '14:10'), ('14:20', '15:50')]
+
+# Text actions resolve on the next reply to the chat, callbacks on answerCallbackQuery
+ACTIONS = [
+    ('schedule_today', 'Сегодня', 3),
+    ('schedule_week', 'На неделю', 2),
+    ('attestation', '📝 Аттестация', 3),
+    ('attendance', None, 2),
+]
+# Scheduler traffic that must not be mistaken for a reply
+BACKGROUND_PREFIXES = ('Напоминание', 'Список посещаемости')
+
+def db_connect():
+    return psycopg2.connect(
+        host=os.getenv('DB_HOST'),
+        port=os.getenv('DB_PORT', '5432'),
+        database=os.getenv('DB_NAME'),
+        user=os.getenv('DB_USER'),
+        password=os.getenv('DB_PASSWORD'),
+    )
+
+def cleanup_database(cursor):
+    cursor.execute("SELECT id FROM students WHERE telegram_id >= %s", (LOADTEST_ID_BASE,))
+    student_ids = [row[0] for row in cursor.fetchall()]
+    for table in ('temp_attendance', 'attestations', 'attendance_journal', 'explanations'):
+        cursor.execute(f"DELETE FROM {table} WHERE student_id = ANY(%s)", (student_ids,))
+    cursor.execute("DELETE FROM students WHERE id = ANY(%s)", (student_ids,))
+    cursor.execute("""
+        DELETE FROM schedules WHERE group_id IN (SELECT id FROM groups WHERE name LIKE %s)
+    """, (LOADTEST_GROUP_PREFIX + '%',))
+    cursor.execute("DELETE FROM groups WHERE name LIKE %s", (LOADTEST_GROUP_PREFIX + '%',))
+    cursor.execute("DELETE FROM subjects WHERE name LIKE %s", (LOADTEST_SUBJECT_PREFIX + '%',))
+
+def seed_database(groups, students_per_group, subjects=12):
+    conn = db_connect()
+    try:
+        cursor = conn.cursor()
+        cleanup_database(cursor)
+        group_ids = [row[0] for row in execute_values(
+            cursor, "INSERT INTO groups (name) VALUES %s RETURNING id",
+            [(f'{LOADTEST_GROUP_PREFIX}{i:03d}',) for i in range(groups)], fetch=True
+        )]
+        subject_ids = [row[0] for row in execute_values(
+            cursor, "INSERT INTO subjects (name) VALUES %s RETURNING id",
+            [(f'{LOADTEST_SUBJECT_PREFIX}{i}',) for i in range(subjects)], fetch=True
+        )]
+        schedule_rows = []
+        for group_idx, group_id in enumerate(group_ids):
+            for day_idx, day in enumerate(DAYS):
+                for slot, (start, end) in enumerate(CLASS_TIMES):
+                    subject_id = subject_ids[(group_idx + day_idx + slot) % len(subject_ids)]
+                    week_type = 'all' if slot < 2 else ('only_even', 'only_odd')[slot % 2]
+                    schedule_rows.append((group_id, day, week_type, subject_id, start, end, 'lecture'))
+        execute_values(cursor, """
+            INSERT INTO schedules (group_id, day_of_week, week_type, subject_id, start_time, end_time, class_type)
+            VALUES %s
+        """, schedule_rows)
+        student_rows = [
+            (f'Студент{n}', f'Нагрузочный{n}', group_ids[n % groups], LOADTEST_ID_BASE + n)
+            for n in range(groups * students_per_group)
+        ]
+        student_ids = [row[0] for row in execute_values(cursor, """
+            INSERT INTO students (first_name, last_name, group_id, telegram_id) VALUES %s RETURNING id
+        """, student_rows, fetch=True)]
+        execute_values(cursor, "INSERT INTO attestations (student_id, subject_id, grade) VALUES %s", [
+            (student_id, subject_id, random.randint(2, 5))
+            for student_id in student_ids for subject_id in subject_ids[:6]
+        ])
+        conn.commit()
+    finally:
+        conn.close()
+    print(f'Создано: групп {groups}, студентов {len(student_ids)}, занятий {len(schedule_rows)}')
+
+def load_students():
+    conn = db_connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, telegram_id FROM students
+            WHERE telegram_id >= %s ORDER BY telegram_id
+        """, (LOADTEST_ID_BASE,))
+        students = cursor.fetchall()
+        cursor.execute("SELECT id FROM subjects WHERE name LIKE %s ORDER BY id LIMIT 1", (LOADTEST_SUBJECT_PREFIX + '%',))
+        subject = cursor.fetchone()
+        if not students or not subject:
+            return [], None, None
+        # Rows the present_/absent_ callbacks look up, as send_class_notification_job would create
+        class_time = datetime.combine(datetime.now().date(), datetime.strptime('09:00', '%H:%M').time())
+        cursor.execute("DELETE FROM temp_attendance WHERE student_id = ANY(%s)", ([s[0] for s in students],))
+        execute_values(cursor, "INSERT INTO temp_attendance (student_id, subject_id, class_time) VALUES %s",
+                       [(student_id, subject[0], class_time) for student_id, _ in students])
+        conn.commit()
+        return students, subject[0], class_time
+    finally:
+        conn.close()
+
+class FakeBotApi:
+    def __init__(self):
+        self.updates = []
+        self.new_updates = asyncio.Event()
+        self.polling = asyncio.Event()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.webhook_url = None
+        self.chat_waiters = {}
+        self.callback_waiters = {}
+        self.calls = {}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                method = path.rsplit('/', 1)[-1]
+                params = self.parse_params(headers.get('content-type', ''), body)
+                result = await self.dispatch(method, params)
+                payload = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+                writer.write(
+                    b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                    b'Content-Length: %d\r\n\r\n' % len(payload) + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    def parse_params(self, content_type, body):
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        if content_type.startswith('multipart/form-data'):
+            # Only plain fields are needed; file contents are discarded
+            fields = re.findall(rb'name="([^"]+)"\r\n\r\n([^\r]*)\r\n', body)
+            return {name.decode(): value.decode('utf-8', errors='replace') for name, value in fields}
+        return {name: values[0] for name, values in parse_qs(body.decode('utf-8')).items()}
+
+    def message(self, chat_id, text=None, **extra):
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+        }
+        if text is not None:
+            message['text'] = text
+        message.update(extra)
+        return message
+
+    async def dispatch(self, method, params):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'getMe':
+            return {'id': 123456, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'loadtest_bot'}
+        if method == 'getUpdates':
+            return await self.get_updates(params)
+        if method == 'setWebhook':
+            self.webhook_url = params.get('url') or None
+            return True
+        if method == 'deleteWebhook':
+            self.webhook_url = None
+            return True
+        if method == 'sendMessage':
+            text = params.get('text', '')
+            if not text.startswith(BACKGROUND_PREFIXES):
+                self.resolve(self.chat_waiters, int(params['chat_id']))
+            return self.message(params['chat_id'], text)
+        if method == 'editMessageText':
+            return self.message(params.get('chat_id', 0), params.get('text', ''))
+        if method == 'sendDocument':
+            self.resolve(self.chat_waiters, int(params['chat_id']))
+            file_id = f'file{next(self.message_ids)}'
+            return self.message(params['chat_id'], document={'file_id': file_id, 'file_unique_id': file_id})
+        if method == 'answerCallbackQuery':
+            self.resolve(self.callback_waiters, params.get('callback_query_id'))
+            return True
+        return True
+
+    def resolve(self, waiters, key):
+        future = waiters.pop(key, None)
+        if future and not future.done():
+            future.set_result(time.perf_counter())
+
+    async def get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        self.updates = [update for update in self.updates if update['update_id'] >= offset]
+        self.polling.set()
+        if not self.updates:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), float(params.get('timeout') or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:100]
+
+    async def push(self, update):
+        update['update_id'] = next(self.update_ids)
+        if self.webhook_url:
+            request = urllib.request.Request(
+                self.webhook_url, data=json.dumps(update).encode('utf-8'),
+                headers={'Content-Type': 'application/json'}
+            )
+            await asyncio.to_thread(urllib.request.urlopen, request)
+        else:
+            self.updates.append(update)
+            self.new_updates.set()
+
+    async def send_text(self, telegram_id, text):
+        future = asyncio.get_running_loop().create_future()
+        self.chat_waiters[telegram_id] = future
+        user = {'id': telegram_id, 'is_bot': False, 'first_name': 'Load'}
+        await self.push({'message': dict(self.message(telegram_id, text), **{'from': user})})
+        return future
+
+    async def press_button(self, telegram_id, data):
+        future = asyncio.get_running_loop().create_future()
+        callback_id = f'cq{next(self.update_ids)}'
+        self.callback_waiters[callback_id] = future
+        await self.push({'callback_query': {
+            'id': callback_id,
+            'from': {'id': telegram_id, 'is_bot': False, 'first_name': 'Load'},
+            'chat_instance': str(telegram_id),
+            'data': data,
+            'message': self.message(telegram_id, 'Напоминание'),
+        }})
+        return future
+
+async def simulate_student(api, student_id, telegram_id, subject_id, class_time, deadline, think_time, timeout, results):
+    kinds = [(kind, text) for kind, text, weight in ACTIONS for _ in range(weight)]
+    while time.perf_counter() < deadline:
+        kind, text = random.choice(kinds)
+        start = time.perf_counter()
+        if kind == 'attendance':
+            future = await api.press_button(telegram_id, f'present_{subject_id}_{student_id}_{int(class_time.timestamp())}')
+        else:
+            future = await api.send_text(telegram_id, text)
+        try:
+            finished = await asyncio.wait_for(future, timeout)
+            results.append((kind, finished - start, True))
+        except asyncio.TimeoutError:
+            results.append((kind, timeout, False))
+        await asyncio.sleep(random.uniform(0, think_time))
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def print_report(results, elapsed, api):
+    print(f'\n{"действие":<16}{"запросов":>10}{"ошибок":>8}{"p50, мс":>10}{"p95, мс":>10}{"p99, мс":>10}{"в сек":>8}')
+    kinds = [kind for kind, _, _ in ACTIONS] + ['всего']
+    for kind in kinds:
+        rows = [row for row in results if kind == 'всего' or row[0] == kind]
+        latencies = sorted(latency for _, latency, ok in rows if ok)
+        errors = sum(1 for _, _, ok in rows if not ok)
+        print(f'{kind:<16}{len(rows):>10}{errors:>8}'
+              f'{percentile(latencies, 0.5) * 1000:>10.1f}'
+              f'{percentile(latencies, 0.95) * 1000:>10.1f}'
+              f'{percentile(latencies, 0.99) * 1000:>10.1f}'
+              f'{len(latencies) / elapsed:>8.1f}')
+    print('\nВызовы Bot API:', ', '.join(f'{name}={count}' for name, count in sorted(api.calls.items())))
+
+async def run(args):
+    if args.seed:
+        seed_database(args.groups, args.students_per_group)
+    students, subject_id, class_time = load_students()
+    if not students:
+        print('Нет тестовых студентов, запустите с --seed.')
+        return 1
+    students = students[:args.students]
+
+    api = FakeBotApi()
+    server = await asyncio.start_server(api.handle_connection, '127.0.0.1', args.port)
+    env = dict(os.environ)
+    env['BOT_TOKEN'] = LOADTEST_TOKEN
+    env['BOT_API_BASE_URL'] = f'http://127.0.0.1:{args.port}/bot'
+    env.setdefault('ADMIN_IDS', '1')
+    with open(args.bot_log, 'w') as log:
+        bot = subprocess.Popen([sys.executable, args.bot], env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        await asyncio.wait_for(api.polling.wait(), 60)
+        print(f'Бот запущен, {len(students)} студентов, {args.duration} с нагрузки...')
+        results = []
+        start = time.perf_counter()
+        deadline = start + args.duration
+        await asyncio.gather(*[
+            simulate_student(api, student_id, telegram_id, subject_id, class_time, deadline, args.think_time, args.timeout,
+                             results)
+            for student_id, telegram_id in students
+        ])
+        print_report(results, time.perf_counter() - start, api)
+    finally:
+        bot.terminate()
+        bot.wait()
+        server.close()
+        if args.cleanup:
+            conn = db_connect()
+            try:
+                cleanup_database(conn.cursor())
+                conn.commit()
+            finally:
+                conn.close()
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест bot.py с поддельным Bot API.')
+    parser.add_argument('--seed', action='store_true', help='пересоздать синтетические группы, студентов и расписание')
+    parser.add_argument('--cleanup', action='store_true', help='удалить синтетические данные после теста')
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--students-per-group', type=int, default=25)
+    parser.add_argument('--students', type=int, default=100, help='число одновременно активных студентов')
+    parser.add_argument('--duration', type=float, default=30, help='длительность нагрузки, с')
+    parser.add_argument('--think-time', type=float, default=1.0, help='максимальная пауза между нажатиями, с')
+    parser.add_argument('--timeout', type=float, default=30, help='сколько ждать ответа бота, с')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--bot', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py'))
+    parser.add_argument('--bot-log', default='loadtest_bot.log')
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args)))
+
+if __name__ == '__main__':
+    main()
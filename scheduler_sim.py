@@ -0,0 +1,185 @@
+"""Симуляция планировщика уведомлений на виртуальных часах.
+
+Прогоняет schedule_daily_notifications, send_class_notification_job,
+collect_attendance_job и автоматическое резервное копирование из bot.py через
+весь семестр за секунды: время подменяется через bot.current_time, задачи
+ставятся в виртуальный планировщик, сообщения уходят в заглушку вместо Telegram.
+База данных настоящая (из переменных DB_*), поэтому используйте тестовую базу,
+например заполненную `python loadtest.py --seed --groups 300`.
+
+    python scheduler_sim.py --days 120
+
+В конце выводятся число задач по видам, выполненные SQL-запросы и пиковая
+одновременность задач по времени суток.
+"""
+import argparse
+import asyncio
+import heapq
+import itertools
+import logging
+import sys
+import time
+from datetime import datetime, timedelta
+
+from apscheduler.triggers.date import DateTrigger
+
+import bot
+
+class VirtualClock:
+    def __init__(self, start):
+        self.current = start
+
+    def now(self):
+        return self.current
+
+class VirtualScheduler:
+    def __init__(self):
+        self.queue = []
+        self.sequence = itertools.count()
+
+    def add_job(self, func, trigger=None, args=None, **kwargs):
+        if not isinstance(trigger, DateTrigger):
+            raise NotImplementedError('Виртуальный планировщик поддерживает только DateTrigger')
+        self.schedule(trigger.run_date.replace(tzinfo=None), func, args or [])
+
+    def schedule(self, run_time, func, args):
+        heapq.heappush(self.queue, (run_time, next(self.sequence), func, args))
+
+    def pop_due_batch(self):
+        run_time = self.queue[0][0]
+        batch = []
+        while self.queue and self.queue[0][0] == run_time:
+            _, _, func, args = heapq.heappop(self.queue)
+            batch.append((func, args))
+        return run_time, batch
+
+class StubMessage:
+    def __init__(self, message_id):
+        self.message_id = message_id
+
+class StubBot:
+    def __init__(self, latency):
+        self.latency = latency
+        self.message_ids = itertools.count(1)
+        self.calls = {}
+
+    async def call(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return StubMessage(next(self.message_ids))
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return await self.call('sendMessage')
+
+    async def send_document(self, chat_id, document, **kwargs):
+        return await self.call('sendDocument')
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        await self.call('deleteMessage')
+        return True
+
+class StubApplication:
+    def __init__(self, latency):
+        self.bot = StubBot(latency)
+        self.bot_data = {}
+
+def statement_counts():
+    with bot.metrics_lock:
+        return {name: sum(series[0]) for name, series in bot.db_query_latency.series.items()}
+
+def diff_counts(before, after):
+    return {name: count - before.get(name, 0) for name, count in after.items() if count != before.get(name, 0)}
+
+class SlotStats:
+    def __init__(self):
+        self.jobs = 0
+        self.statements = 0
+        self.peak = 0
+        self.busy = 0.0
+
+async def simulate(args):
+    start = datetime.combine(args.start, datetime.min.time())
+    end = start + timedelta(days=args.days)
+    clock = VirtualClock(start)
+    virtual_scheduler = VirtualScheduler()
+    application = StubApplication(args.send_latency)
+    backups = []
+
+    async def stub_backup(application, *chat_ids):
+        for chat_id in chat_ids:
+            backups.append(chat_id)
+            await application.bot.send_document(chat_id=chat_id, document=None)
+
+    bot.current_time = clock.now
+    bot.scheduler = virtual_scheduler
+    # Cleanup pacing sleeps on the wall clock, which would stretch a semester into hours
+    bot.REMINDER_CLEANUP_RATE = float('inf')
+    if not args.real_backup:
+        bot.perform_backup_and_send = stub_backup
+    bot.load_role_cache()
+    bot.load_academic_calendar()
+
+    # Same recurring jobs as schedule_jobs(): daily planning at midnight, backup every 3 hours
+    day = start
+    while day < end:
+        virtual_scheduler.schedule(day, bot.schedule_daily_notifications, [application])
+        day += timedelta(days=1)
+    backup_time = start + timedelta(hours=3)
+    while backup_time < end:
+        virtual_scheduler.schedule(backup_time, bot.automatic_backup_database, [application])
+        backup_time += timedelta(hours=3)
+
+    job_counts = {}
+    slots = {}
+    statements_before = statement_counts()
+    wall_start = time.perf_counter()
+    while virtual_scheduler.queue:
+        run_time, batch = virtual_scheduler.pop_due_batch()
+        if run_time >= end:
+            break
+        clock.current = run_time
+        for func, _ in batch:
+            name = func.__name__
+            job_counts[name] = job_counts.get(name, 0) + 1
+        batch_before = statement_counts()
+        batch_start = time.perf_counter()
+        # Jobs due at the same instant run concurrently, as under AsyncIOScheduler
+        await asyncio.gather(*[func(*job_args) for func, job_args in batch])
+        slot = slots.setdefault(run_time.strftime('%H:%M'), SlotStats())
+        slot.jobs += len(batch)
+        slot.peak = max(slot.peak, len(batch))
+        slot.busy += time.perf_counter() - batch_start
+        slot.statements += sum(diff_counts(batch_before, statement_counts()).values())
+    elapsed = time.perf_counter() - wall_start
+
+    print(f'Симулировано {args.days} дн. с {args.start} за {elapsed:.1f} с')
+    print('\nЗадачи:')
+    for name, count in sorted(job_counts.items()):
+        print(f'  {name:<32}{count:>10}')
+    print('\nВызовы Bot API:')
+    for name, count in sorted(application.bot.calls.items()):
+        print(f'  {name:<32}{count:>10}')
+    print('\nSQL-запросы:')
+    for name, count in sorted(diff_counts(statements_before, statement_counts()).items(), key=lambda item: -item[1]):
+        print(f'  {name:<32}{count:>10}')
+    print(f'\n{"время":<8}{"задач":>10}{"пик":>6}{"запросов":>11}{"время работы, с":>18}')
+    for slot_time, slot in sorted(slots.items()):
+        print(f'{slot_time:<8}{slot.jobs:>10}{slot.peak:>6}{slot.statements:>11}{slot.busy:>18.2f}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Симуляция планировщика bot.py на виртуальных часах.')
+    parser.add_argument('--start', type=lambda value: datetime.strptime(value, '%Y-%m-%d').date(),
+                        default=datetime.now().date(), help='первый день семестра, ГГГГ-ММ-ДД')
+    parser.add_argument('--days', type=int, default=120)
+    parser.add_argument('--send-latency', type=float, default=0.0, help='задержка заглушки Bot API на вызов, с')
+    parser.add_argument('--real-backup', action='store_true', help='запускать настоящий pg_dump вместо заглушки')
+    parser.add_argument('--verbose', action='store_true', help='не приглушать логи бота')
+    args = parser.parse_args()
+    if not args.verbose:
+        bot.logger.setLevel(logging.ERROR)
+    asyncio.run(simulate(args))
+    sys.exit(0)
+
+if __name__ == '__main__':
+    main()